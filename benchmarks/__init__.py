@@ -0,0 +1,4 @@
+"""
+Performance benchmarks for the Smart WhatsApp Chatbot
+Run from the repository root, e.g. `python -m benchmarks.bench_matcher`
+"""
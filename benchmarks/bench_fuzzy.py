@@ -0,0 +1,100 @@
+"""
+Fuzzy-match benchmark: difflib over every pattern vs the FuzzyIndex shortlist
+
+Checks that both return the same best match and score at the 0.65
+threshold used by get_smart_response, then times them.
+
+Usage: python -m benchmarks.bench_fuzzy [--messages N] [--rounds N]
+"""
+
+import argparse
+import random
+import time
+
+import chat
+from benchmarks.bench_matcher import build_knowledge_base
+
+SIZES = [None, 1000, 2500]  # None = the real KNOWLEDGE_BASE
+THRESHOLD = 0.65
+
+
+def make_typo(text, rng):
+    """Apply one random deletion, insertion, substitution or swap"""
+    if len(text) < 2:
+        return text + rng.choice("aeiou")
+    i = rng.randrange(len(text) - 1)
+    edit = rng.randrange(4)
+    if edit == 0:
+        return text[:i] + text[i + 1:]
+    if edit == 1:
+        return text[:i] + rng.choice("aeiou ") + text[i:]
+    if edit == 2:
+        return text[:i] + rng.choice("etaoinsr") + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def build_corpus(patterns, count, seed=7):
+    """Typo'd knowledge base patterns mixed with unrelated messages"""
+    rng = random.Random(seed)
+    misses = ["this message does not match anything", "asdf", "ok", "zzzz zzz",
+              "can you help me plan my week", "i like turtles"]
+    corpus = []
+    for _ in range(count):
+        if rng.random() < 0.2:
+            corpus.append(rng.choice(misses))
+        else:
+            message = rng.choice(patterns)
+            for _ in range(rng.randint(1, 3)):
+                message = make_typo(message, rng)
+            corpus.append(message)
+    return corpus
+
+
+def check_parity(index, corpus):
+    """Return the messages where the index disagrees with the linear scan"""
+    mismatches = []
+    for message in corpus:
+        expected = chat.fuzzy_match(message, index.patterns, threshold=THRESHOLD)
+        actual = chat.fuzzy_match(message, index.fuzzy, threshold=THRESHOLD)
+        if expected != actual:
+            mismatches.append((message, expected, actual))
+    return mismatches
+
+
+def time_per_message(patterns, corpus, rounds):
+    """Return mean microseconds per message"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in corpus:
+            chat.fuzzy_match(message, patterns, threshold=THRESHOLD)
+    return (time.perf_counter() - start) / (rounds * len(corpus)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'patterns':>10} {'parity':>8} {'difflib us':>12} {'indexed us':>12} {'speedup':>8}")
+    failed = False
+    for size in SIZES:
+        index = chat.PatternIndex(build_knowledge_base(size))
+        corpus = build_corpus(index.patterns, args.messages)
+
+        mismatches = check_parity(index, corpus)
+        for message, expected, actual in mismatches[:5]:
+            print(f"  MISMATCH {message!r}: expected {expected}, got {actual}")
+        failed = failed or bool(mismatches)
+
+        linear = time_per_message(index.patterns, corpus, args.rounds)
+        indexed = time_per_message(index.fuzzy, corpus, args.rounds)
+        parity = "ok" if not mismatches else f"{len(mismatches)} bad"
+        print(f"{len(index.patterns):>10} {parity:>8} {linear:>12.1f} {indexed:>12.1f} "
+              f"{linear / indexed:>7.1f}x")
+
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
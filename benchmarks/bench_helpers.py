@@ -0,0 +1,130 @@
+"""
+Micro-benchmarks for the NLP helpers, with JSON baselines and regression gates
+
+Times get_sentiment, correct_spelling, calculate_expression, fuzzy_match and
+extract_context over short, medium and long messages (and, for fuzzy_match and
+spelling lookups, growing knowledge base sizes). The "cold" spelling cases clear
+the correction memo before every call, so each typo is really looked up.
+
+Usage:
+  python -m benchmarks.bench_helpers --save-baseline
+  python -m benchmarks.bench_helpers --compare [--tolerance 0.25]
+  python -m benchmarks.bench_helpers --only fuzzy_match
+"""
+
+import argparse
+import time
+
+import chat
+from benchmarks.bench_matcher import build_knowledge_base
+from benchmarks.common import (baseline_path, compare, load_baseline, quiet, report_regressions,
+                               save_baseline)
+
+MESSAGES = {
+    "short": "helo thnks",
+    "medium": "wat is the tyme now? i am so happy and excited, this bot is great",
+    "long": ("hello there, i wanted to say thanks for all the great jokes yesterday, they were "
+             "awesome! but honestly today i feel a bit sad and frustrated because work was boring "
+             "and my boss was annoying. can u tell me something interesting, or maybe calculate "
+             "how many hours are in 52 weeks? what is 52 * 7 * 24 anyway? plz help, ur the best"),
+}
+MATH_MESSAGES = {
+    "short": "2 + 2",
+    "medium": "what is (12.5 * 4) / 2 + 7",
+    "long": "calculate " + " + ".join(str(n) for n in range(1, 40)),
+}
+FUZZY_MESSAGES = {
+    "short": "jok",
+    "medium": "tel me somthing intresting",
+    "long": "can you plese tell me what the capitl city of the united kingdm is called",
+}
+# Five typos the spelling index has to look up (none are fixed corrections)
+TYPO_MESSAGE = "wether plese scince intresting somthing"
+KB_SIZES = [None, 1000, 2500]  # None = the real KNOWLEDGE_BASE
+BUDGET = 0.2  # Seconds spent timing each case
+
+
+def time_call(func, *args):
+    """Microseconds per call: best of 3 runs sized to fill the budget"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= BUDGET / 10 or loops >= 1_000_000:
+            break
+        loops *= 10
+    best = elapsed
+    for _ in range(2):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+    return round(best / loops * 1e6, 3)
+
+
+def conversation_after_joke():
+    conversation = chat.Conversation(0.0)
+    conversation.add_exchange("tell me a joke", chat.KNOWLEDGE_BASE["joke"]["responses"][0])
+    return conversation
+
+
+def correct_spelling_cold(message):
+    """correct_spelling with the memo cleared first"""
+    chat.PATTERN_INDEX.spelling.memo.clear()
+    return chat.correct_spelling(message)
+
+
+def correct_words_cold(spelling, words):
+    """Look every word up in a SpellingIndex with its memo cleared first"""
+    spelling.memo.clear()
+    return [spelling.correct(word) for word in words]
+
+
+def cases():
+    """Yield (name, func, args) for every benchmark case"""
+    conversation = conversation_after_joke()
+    for size, message in MESSAGES.items():
+        yield f"get_sentiment/{size}", chat.get_sentiment, (message,)
+        yield f"correct_spelling/{size}", chat.correct_spelling, (chat.normalize_message(message),)
+        yield f"extract_context/{size}", chat.extract_context, (message, conversation)
+    yield "correct_spelling/cold", correct_spelling_cold, (TYPO_MESSAGE,)
+    for size, message in MATH_MESSAGES.items():
+        yield f"calculate_expression/{size}", chat.calculate_expression, (message,)
+    for kb_size in KB_SIZES:
+        index = chat.PatternIndex(build_knowledge_base(kb_size))
+        label = "kb" if kb_size is None else f"kb{kb_size}"
+        for size, message in FUZZY_MESSAGES.items():
+            yield f"fuzzy_match/{label}/{size}", chat.fuzzy_match, (message, index.fuzzy, 0.65)
+        yield f"spelling/{label}/cold", correct_words_cold, (index.spelling, TYPO_MESSAGE.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--only", help="run only cases whose name starts with this")
+    parser.add_argument("--save-baseline", nargs="?", const="", metavar="PATH")
+    parser.add_argument("--compare", nargs="?", const="", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, e.g. 0.25 = 25%%")
+    args = parser.parse_args()
+
+    quiet()
+    results = {}
+    for name, func, call_args in cases():
+        if args.only and not name.startswith(args.only):
+            continue
+        results[name] = {"us_per_call": time_call(func, *call_args)}
+        print(f"{name:<36} {results[name]['us_per_call']:>12.3f} us")
+
+    if args.save_baseline is not None:
+        path = args.save_baseline or baseline_path("helpers")
+        save_baseline(path, results)
+        print(f"\nBaseline saved to {path}")
+    if args.compare is not None:
+        path = args.compare or baseline_path("helpers")
+        raise SystemExit(report_regressions(compare(load_baseline(path), results, args.tolerance),
+                                            args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
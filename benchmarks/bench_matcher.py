@@ -0,0 +1,84 @@
+"""
+Exact-match benchmark: linear pattern scan vs PatternIndex.match
+
+Grows a synthetic knowledge base from today's size up to 10,000 patterns
+and times both matchers over the same message corpus.
+
+Usage: python -m benchmarks.bench_matcher [--rounds N]
+"""
+
+import argparse
+import random
+import time
+
+import chat
+
+SIZES = [None, 1000, 2500, 5000, 10000]  # None = the real KNOWLEDGE_BASE
+
+MESSAGES = [
+    "hello",
+    "hi there, how are you?",
+    "tell me a joke",
+    "what is the capital of france",
+    "can you tell me something interesting about space",
+    "i am feeling down today and need some motivation",
+    "what is artificial intelligence and how does it work",
+    "this message does not match anything in the knowledge base at all",
+    "thnks",
+    "what time is it",
+]
+
+
+def build_knowledge_base(size, seed=42):
+    """Extend the real knowledge base with synthetic patterns up to size"""
+    knowledge_base = dict(chat.KNOWLEDGE_BASE)
+    if size is None:
+        return knowledge_base
+
+    rng = random.Random(seed)
+    vocabulary = sorted({word for data in chat.KNOWLEDGE_BASE.values()
+                         for pattern in data["patterns"] for word in pattern.split()})
+    count = sum(len(data["patterns"]) for data in knowledge_base.values())
+    category = 0
+    while count < size:
+        patterns = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(1, 4)))
+                    for _ in range(min(10, size - count))]
+        knowledge_base[f"synthetic_{category}"] = {"patterns": patterns, "responses": ["..."]}
+        count += len(patterns)
+        category += 1
+    return knowledge_base
+
+
+def time_matcher(match, messages, rounds):
+    """Return mean microseconds per message"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            match(message, message)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(messages)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'patterns':>10} {'build ms':>10} {'linear us':>11} {'indexed us':>11} {'speedup':>8}")
+    for size in SIZES:
+        knowledge_base = build_knowledge_base(size)
+        start = time.perf_counter()
+        index = chat.PatternIndex(knowledge_base)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        for message in MESSAGES:
+            assert index.match(message, message) == index.match_linear(message, message), message
+
+        linear = time_matcher(index.match_linear, MESSAGES, args.rounds)
+        indexed = time_matcher(index.match, MESSAGES, args.rounds)
+        print(f"{len(index.pairs):>10} {build_ms:>10.1f} {linear:>11.1f} {indexed:>11.1f} "
+              f"{linear / indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
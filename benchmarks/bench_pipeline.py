@@ -0,0 +1,129 @@
+"""
+End-to-end benchmark and load generator for the response pipeline
+
+Replays a realistic corpus (greetings, math, typos, fuzzy-path misses and
+context follow-ups) and reports msgs/sec, latency percentiles and memory
+allocated per message.
+
+Modes:
+  direct   call get_response() in-process
+  webhook  POST to /whatsapp through Flask's test client
+  http     POST to a running server (e.g. local gunicorn) given by --url
+
+Usage:
+  python -m benchmarks.bench_pipeline --mode direct --save-baseline
+  python -m benchmarks.bench_pipeline --mode direct --compare
+"""
+
+import argparse
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import chat
+from benchmarks.common import (baseline_path, compare, load_baseline, percentiles, quiet,
+                               report_regressions, save_baseline)
+from benchmarks.corpus import build_corpus
+
+
+def reset_state():
+    """Start every run cold so runs are comparable"""
+    chat.RESPONSE_CACHE.clear()
+    chat.conversations.clear()
+
+
+def make_sender(mode, url):
+    """Return a function that sends one (phone, message) pair"""
+    if mode == "direct":
+        return lambda phone, message: chat.get_response(message, phone)
+    if mode == "webhook":
+        client = chat.app.test_client()
+        return lambda phone, message: client.post("/whatsapp", data={"Body": message, "From": phone})
+
+    def send(phone, message):
+        data = urllib.parse.urlencode({"Body": message, "From": phone}).encode()
+        with urllib.request.urlopen(url, data=data, timeout=30) as reply:
+            return reply.read()
+    return send
+
+
+def run_timed(send, corpus, concurrency):
+    """Return (elapsed seconds, per-message latencies)"""
+    def timed(item):
+        start = time.perf_counter()
+        send(*item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed, corpus))
+    else:
+        latencies = [timed(item) for item in corpus]
+    return time.perf_counter() - start, latencies
+
+
+def measure_allocations(send, corpus):
+    """Mean peak KiB allocated while handling a message, and bytes retained after it"""
+    tracemalloc.start()
+    peak_total = 0
+    retained_total = 0
+    try:
+        for phone, message in corpus:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            send(phone, message)
+            current, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - before
+            retained_total += current - before
+    finally:
+        tracemalloc.stop()
+    return round(peak_total / len(corpus) / 1024, 2), round(retained_total / len(corpus), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mode", choices=["direct", "webhook", "http"], default="direct")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/whatsapp", help="target for --mode http")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel senders (http mode)")
+    parser.add_argument("--save-baseline", nargs="?", const="", metavar="PATH")
+    parser.add_argument("--compare", nargs="?", const="", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, e.g. 0.25 = 25%%")
+    args = parser.parse_args()
+
+    quiet()
+    corpus = build_corpus(args.messages, users=args.users)
+    send = make_sender(args.mode, args.url)
+
+    reset_state()
+    elapsed, latencies = run_timed(send, corpus, args.concurrency if args.mode == "http" else 1)
+    result = {"msgs_per_sec": round(len(corpus) / elapsed, 1)}
+    result.update(percentiles(latencies))
+
+    if args.mode != "http":
+        reset_state()
+        result["alloc_peak_kib"], result["retained_bytes"] = measure_allocations(send, corpus)
+
+    name = f"pipeline_{args.mode}"
+    print(f"{name}: {len(corpus)} messages from {args.users} users")
+    for metric, value in result.items():
+        print(f"  {metric:>16}: {value}")
+
+    results = {name: result}
+    if args.save_baseline is not None:
+        path = args.save_baseline or baseline_path(name)
+        save_baseline(path, results)
+        print(f"\nBaseline saved to {path}")
+    if args.compare is not None:
+        path = args.compare or baseline_path(name)
+        regressions = compare(load_baseline(path), results, args.tolerance,
+                              higher_is_better={"msgs_per_sec"})
+        raise SystemExit(report_regressions(regressions, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
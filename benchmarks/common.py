@@ -0,0 +1,83 @@
+"""
+Shared helpers for the benchmarks: quiet setup, percentiles and JSON baselines
+"""
+
+import json
+import os
+import platform
+import time
+
+import chat
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+
+def quiet():
+    """Silence console logging so it doesn't skew timings"""
+    chat.log_pipeline.level = chat.LOG_LEVELS["quiet"]
+
+
+def percentiles(samples):
+    """p50/p95/p99 of a list of seconds, in milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 4)
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(path, results):
+    """Write results with enough context to judge a later comparison"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def compare(baseline, results, tolerance, higher_is_better=()):
+    """Return (name, metric, old, new) for every metric worse than tolerance allows
+
+    baseline and results map a benchmark name to {metric: value}. Metrics
+    are "lower is better" unless listed in higher_is_better.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, new in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or not old:
+                continue
+            if metric in higher_is_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def report_regressions(regressions, tolerance):
+    """Print regressions; returns the process exit code"""
+    if not regressions:
+        print(f"\nNo regressions beyond {tolerance:.0%} of baseline.")
+        return 0
+    print(f"\nREGRESSIONS beyond {tolerance:.0%} of baseline:")
+    for name, metric, old, new in regressions:
+        print(f"  {name} {metric}: {old} -> {new}")
+    return 1
@@ -0,0 +1,39 @@
+"""
+Realistic message corpus for replaying traffic against the bot
+"""
+
+import random
+
+GREETINGS = ["hello", "hi", "hey there", "good morning", "whats up", "hola"]
+QUESTIONS = ["what is the capital of france", "what is ai", "tell me about nigeria",
+             "what is python", "who are you", "what can you do", "what time is it",
+             "what is the date today", "explain physics", "capital of japan"]
+MATH = ["what is 25 * 4", "calculate 100 / 5", "2 + 2", "12.5 x 3", "(3 + 4) * 2",
+        "what is 2^10", "15 minus 7", "9 divided by 3", "what is 5²"]
+TYPOS = ["helo", "thnks", "tel me a jok", "wat is the tyme", "calculat 5 + 5",
+         "motivte me", "tell me a fakt", "hw are you"]
+MISSES = ["can you book me a flight to lagos", "my printer keeps jamming",
+          "what should i cook for dinner tonight", "recommend a good movie",
+          "how do i fix my bicycle chain", "zzzz qqq"]
+FOLLOW_UPS = [("tell me a joke", "another one"), ("tell me a fact", "one more"),
+              ("make me laugh", "again")]
+MIX = [(GREETINGS, 0.15), (QUESTIONS, 0.25), (MATH, 0.15), (TYPOS, 0.15), (MISSES, 0.15), (FOLLOW_UPS, 0.15)]
+
+
+def build_corpus(count, users=50, seed=1234):
+    """Return [(phone, message)] mixing every kind of traffic across users"""
+    rng = random.Random(seed)
+    phones = [f"whatsapp:+23480000{i:05d}" for i in range(users)]
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    corpus = []
+    while len(corpus) < count:
+        phone = rng.choice(phones)
+        kind = rng.choices(kinds, weights)[0]
+        if kind is FOLLOW_UPS:
+            first, follow_up = rng.choice(FOLLOW_UPS)
+            corpus.append((phone, first))
+            corpus.append((phone, follow_up))
+        else:
+            corpus.append((phone, rng.choice(kind)))
+    return corpus[:count]
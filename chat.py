@@ -4,17 +4,35 @@ Smart WhatsApp Chatbot for University Presentation
 Fully functional chatbot using pattern matching, NLP techniques, and knowledge bases
 """
 
-from flask import Flask, request, render_template_string
+from flask import Flask, Response, request, render_template_string
 from twilio.twiml.messaging_response import MessagingResponse
 from datetime import datetime, timedelta, timezone
 
 # West Africa Time (UTC+1)
 WAT = timezone(timedelta(hours=1))
+import os
+import queue
 import random
 import re
-import hashlib
+import atexit
+from array import array
+from bisect import bisect_left
 import difflib
+import gc
+import io
+import json
+import mmap
+import pickle
+import signal
+import struct
+import sqlite3
 import string
+import sys
+import tempfile
+from collections import Counter, OrderedDict, deque
+import threading
+import time
+import zlib
 
 app = Flask(__name__)
 
@@ -22,22 +40,65 @@ app = Flask(__name__)
 AI_PROVIDER = "Smart Local Engine"
 print("🧠 Running Smart Local Engine - No external AI APIs needed!")
 
-# Data storage
-conversations = {}
-message_log = []
-stats = {
-    "total_messages": 0,
-    "total_users": 0,
-    "total_smart_calls": 0,
-    "total_cached_calls": 0,
-    "total_pattern_matches": 0,
-    "total_fuzzy_matches": 0,
-    "start_time": datetime.now(WAT)
-}
+START_TIME = datetime.now(WAT)
 
 # Response Cache for performance
-RESPONSE_CACHE = {}
 CACHE_DURATION = 300  # 5 minutes cache
+CACHE_MAX_ENTRIES = 5000  # Least recently used entries are evicted past this
+CACHE_SWEEP_INTERVAL = 60  # Seconds between sweeps of expired entries
+# "memory" keeps a cache per worker process; "sqlite" shares one file between
+# all gunicorn workers on the node
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+CACHE_PATH = os.environ.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "chatbot_cache.sqlite3"))
+
+# Message log for the dashboard
+MESSAGE_LOG_SIZE = 500  # Records kept in memory
+MESSAGE_LOG_PATH = os.environ.get("MESSAGE_LOG_PATH")  # Optional JSON lines file for older records
+
+# Conversation memory
+CONVERSATION_HISTORY = 10  # Messages kept per user (user + assistant turns)
+CONVERSATION_IDLE_TTL = 6 * 60 * 60  # Forget users idle for 6 hours
+CONVERSATION_MAX_USERS = 100000  # Least recently active users are evicted past this
+CONVERSATION_SWEEP_INTERVAL = 300  # Seconds between sweeps of idle users
+CONVERSATION_SEEN_BITS = 1 << 23  # Bloom filter of users ever seen (1 MiB, ~1% false positives at 800k users)
+
+# "memory" keeps conversations, stats and the message log in this process only;
+# "sqlite" persists them to a local file shared by every worker and restart
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_PATH = os.environ.get("STATE_PATH", os.path.join(tempfile.gettempdir(), "chatbot_state.sqlite3"))
+STATE_FLUSH_INTERVAL = 0.5  # Seconds between batched background writes
+
+# Console logging: "quiet", "info" (one line per event) or "verbose" (banners)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "verbose")
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer; newer records are dropped past this
+LOG_BATCH_SIZE = 256  # Records formatted and written per stdout write
+
+# Fraction of requests whose pipeline stages are timed for /metrics
+LATENCY_SAMPLE_RATE = float(os.environ.get("LATENCY_SAMPLE_RATE", "1.0"))
+
+# Spelling correction beyond SPELLING_CORRECTIONS: unknown words are replaced
+# by the closest knowledge base pattern word within a small edit distance
+SPELLING_MAX_DISTANCE = 2  # Edits allowed for words of 8+ letters (shorter words get 1)
+SPELLING_MIN_LENGTH = 5  # Shorter words are left to SPELLING_CORRECTIONS
+SPELLING_MAX_LENGTH = 20  # Longer tokens (links, keyboard mashes) are never corrected
+SPELLING_MAX_LOOKUPS = 8  # Unknown words looked up per message
+SPELLING_MEMO_SIZE = 10000  # Remembered lookups before the memo is cleared
+SPELLING_WORDS_PATH = os.environ.get(  # Common English words (one per line) that are never corrected
+    "SPELLING_WORDS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "english_words.txt"))
+
+# Math evaluation limits, so a crafted expression cannot pin a worker
+MATH_MAX_TOKENS = 200  # Numbers, operators and parentheses in one expression
+MATH_MAX_DEPTH = 16  # Nested parentheses
+MATH_MAX_STEPS = 100  # Operations evaluated
+MATH_MAX_OPERAND = 1e15  # Largest number accepted as input
+MATH_MAX_EXPONENT = 1000  # Largest power accepted for ^
+MATH_MAX_RESULT = 1e100  # Largest intermediate or final result
+
+# Knowledge base: edited as JSON, loaded through a compiled snapshot of the
+# knowledge base and its indexes, and reloaded when the JSON changes or on SIGHUP
+KB_PATH = os.environ.get("KB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge_base.json"))
+KB_SNAPSHOT_PATH = os.environ.get("KB_SNAPSHOT_PATH", os.path.splitext(KB_PATH)[0] + ".snapshot")
+KB_CHECK_INTERVAL = 2  # Seconds between checks of the JSON file's modification time
 
 FEATURES = {
     "sentiment": True,
@@ -53,734 +114,38 @@ FEATURES = {
 # EXPANDED KNOWLEDGE BASE - Comprehensive Local Intelligence
 # ==================================================================
 
-KNOWLEDGE_BASE = {
-    # Greetings
-    "greeting": {
-        "patterns": ["hello", "hi", "hey", "good morning", "good afternoon", "good evening",
-                     "howdy", "sup", "yo", "hola", "greetings", "what's up", "whats up"],
-        "responses": [
-            "👋 Hello! I'm your smart assistant. How can I help you today?",
-            "Hi there! 😊 What can I do for you?",
-            "Hey! Great to hear from you! What's on your mind?",
-            "Hello! 🌟 Ready to assist you. What do you need?",
-            "Hi! 👋 I'm here to help. Ask me anything!",
-        ]
-    },
-
-    # Questions about Bot
-    "who_are_you": {
-        "patterns": ["who are you", "what are you", "tell me about yourself", "your name",
-                     "introduce yourself", "what can you do", "your capabilities"],
-        "responses": [
-            "I'm a smart WhatsApp chatbot! 🤖 I use advanced pattern matching and local intelligence to help you. I can answer questions, tell jokes, do math, share facts, and have conversations!",
-            "I'm your friendly assistant! Built with Python and powered by smart algorithms - no cloud AI needed! 😊 Ask me about time, weather, math, jokes, facts, or just chat!",
-        ]
-    },
-
-    # How are you
-    "how_are_you": {
-        "patterns": ["how are you", "how r u", "how do you do", "are you okay", "you good",
-                     "how's it going", "hows it going", "wassup", "what's good"],
-        "responses": [
-            "I'm doing great, thanks for asking! 😊 Ready to help you with anything!",
-            "I'm excellent! Running smoothly and ready to chat! 🚀 How about you?",
-            "All systems operational! 💪 What can I help you with today?",
-        ]
-    },
-
-    # Geography Knowledge
-    "geography": {
-        "patterns": ["usa in africa", "is usa in africa", "where is usa", "usa location",
-                     "america continent", "united states continent"],
-        "responses": [
-            "No, the USA is not in Africa! 🌍 The United States is in North America, while Africa is a separate continent. They're on different sides of the Atlantic Ocean!",
-        ]
-    },
-
-    # Capitals Database
-    "capitals": {
-        "patterns": ["capital of", "capital city", "what is the capital"],
-        "responses": [
-            "🏛️ I know many world capitals! Here are some:\n• USA - Washington D.C.\n• UK - London\n• France - Paris\n• Germany - Berlin\n• Japan - Tokyo\n• Nigeria - Abuja\n• Egypt - Cairo\n• India - New Delhi\n• China - Beijing\n• Brazil - Brasília\n\nAsk me about a specific country!",
-        ]
-    },
-
-    # Specific Capitals
-    "capital_usa": {
-        "patterns": ["capital of usa", "capital of america", "capital of united states", "us capital"],
-        "responses": ["🏛️ The capital of the United States is Washington D.C.!"]
-    },
-    "capital_uk": {
-        "patterns": ["capital of uk", "capital of england", "capital of britain", "uk capital"],
-        "responses": ["🏛️ The capital of the United Kingdom is London!"]
-    },
-    "capital_france": {
-        "patterns": ["capital of france", "french capital"],
-        "responses": ["🏛️ The capital of France is Paris! 🗼"]
-    },
-    "capital_nigeria": {
-        "patterns": ["capital of nigeria", "nigerian capital"],
-        "responses": ["🏛️ The capital of Nigeria is Abuja!"]
-    },
-    "capital_japan": {
-        "patterns": ["capital of japan", "japanese capital"],
-        "responses": ["🏛️ The capital of Japan is Tokyo! 🗾"]
-    },
-
-    # Jokes - Expanded
-    "joke": {
-        "patterns": ["joke", "make me laugh", "funny", "humor", "tell me a joke", "another joke"],
-        "responses": [
-            "Why don't scientists trust atoms? Because they make up everything! 😄",
-            "What do you call a bear with no teeth? A gummy bear! 🐻",
-            "Why did the scarecrow win an award? He was outstanding in his field! 🌾",
-            "What do you call a fake noodle? An impasta! 🍝",
-            "Why don't eggs tell jokes? They'd crack each other up! 🥚",
-            "What did the ocean say to the beach? Nothing, it just waved! 🌊",
-            "Why did the bicycle fall over? Because it was two-tired! 🚲",
-            "What do you call a fish without eyes? A fsh! 🐟",
-            "Why don't skeletons fight each other? They don't have the guts! 💀",
-            "What do you call a lazy kangaroo? A pouch potato! 🦘",
-            "Why did the math book look so sad? Because it had too many problems! 📚",
-            "What do you call a dog that does magic? A Labracadabrador! 🐕",
-            "Why did the coffee file a police report? It got mugged! ☕",
-            "What do you call a sleeping dinosaur? A dino-snore! 🦕",
-        ]
-    },
-
-    # Facts - Expanded
-    "fact": {
-        "patterns": ["fact", "tell me something interesting", "did you know", "random fact",
-                     "interesting fact", "fun fact", "cool fact"],
-        "responses": [
-            "🧠 Did you know? Honey never spoils! Archaeologists have found 3000-year-old honey in Egyptian tombs that's still edible!",
-            "🌊 Fun fact: The Atlantic Ocean is saltier than the Pacific Ocean!",
-            "🐙 Cool fact: Octopuses have three hearts and blue blood!",
-            "☀️ Amazing fact: It takes sunlight 8 minutes and 20 seconds to reach Earth!",
-            "🦒 Interesting fact: A giraffe's tongue is about 20 inches long!",
-            "🐝 Did you know? Bees can recognize human faces!",
-            "🌙 Fun fact: A day on Venus is longer than a year on Venus!",
-            "🦈 Cool fact: Sharks have been around longer than trees!",
-            "🧊 Amazing: Hot water freezes faster than cold water (Mpemba effect)!",
-            "🐘 Elephants are the only animals that can't jump!",
-            "🍯 A group of flamingos is called a 'flamboyance'! 🦩",
-            "💎 Diamonds can be made from peanut butter!",
-            "🌍 Russia has a larger surface area than Pluto!",
-            "🐌 Snails can sleep for up to 3 years!",
-        ]
-    },
-
-    # Science Topics
-    "science": {
-        "patterns": ["what is science", "explain science", "science definition"],
-        "responses": [
-            "🔬 Science is the systematic study of the natural world through observation and experimentation! It helps us understand how things work, from tiny atoms to massive galaxies. The main branches are Physics, Chemistry, Biology, and Earth Sciences.",
-        ]
-    },
-
-    "physics": {
-        "patterns": ["what is physics", "explain physics", "physics definition"],
-        "responses": [
-            "⚛️ Physics is the study of matter, energy, and how they interact! It covers everything from the motion of planets to the behavior of subatomic particles. Famous physicists include Einstein, Newton, and Hawking!",
-        ]
-    },
-
-    "chemistry": {
-        "patterns": ["what is chemistry", "explain chemistry", "chemistry definition"],
-        "responses": [
-            "🧪 Chemistry is the science of matter and its transformations! It studies atoms, molecules, and how substances react with each other. Everything around you - from your phone to the air you breathe - involves chemistry!",
-        ]
-    },
-
-    "biology": {
-        "patterns": ["what is biology", "explain biology", "biology definition"],
-        "responses": [
-            "🧬 Biology is the study of life and living organisms! It covers everything from tiny bacteria to giant whales, including how they grow, reproduce, and evolve. Sub-fields include genetics, ecology, and anatomy!",
-        ]
-    },
-
-    # Technology Topics
-    "what_is_ai": {
-        "patterns": ["what is ai", "what is artificial intelligence", "explain ai", "ai definition"],
-        "responses": [
-            "🤖 Artificial Intelligence (AI) is technology that enables computers to simulate human intelligence! This includes learning from data, recognizing patterns, making decisions, and understanding language. AI powers everything from voice assistants to self-driving cars!",
-        ]
-    },
-
-    "what_is_programming": {
-        "patterns": ["what is programming", "what is coding", "explain programming"],
-        "responses": [
-            "💻 Programming is the art of giving instructions to computers! Developers write code in languages like Python, JavaScript, or Java to create apps, websites, games, and more. It's like writing a recipe that computers can follow!",
-        ]
-    },
-
-    "what_is_python": {
-        "patterns": ["what is python", "python programming", "explain python"],
-        "responses": [
-            "🐍 Python is a popular programming language known for being easy to read and learn! It's used for web development, data science, AI, automation, and much more. This very chatbot is built with Python!",
-        ]
-    },
-
-    # Weather (Simulated)
-    "weather": {
-        "patterns": ["weather", "what's the weather", "how's the weather", "temperature outside"],
-        "responses": [
-            "🌤️ I don't have access to real-time weather data, but you can check your local weather app or visit weather.com! Pro tip: Ask me about anything else - jokes, facts, math, or just chat!",
-        ]
-    },
-
-    # Motivational
-    "motivation": {
-        "patterns": ["motivate me", "inspire me", "i need motivation", "feeling down",
-                     "cheer me up", "sad", "depressed", "unhappy"],
-        "responses": [
-            "💪 You've got this! Remember: Every expert was once a beginner. Keep pushing forward!",
-            "🌟 Believe in yourself! The only limit to your potential is the one you set for yourself.",
-            "🚀 Every day is a new opportunity to grow. You're stronger than you think!",
-            "✨ Tough times don't last, but tough people do! Keep your head up!",
-            "🌈 After every storm comes a rainbow. Better days are ahead!",
-        ]
-    },
-
-    # Compliments
-    "compliment": {
-        "patterns": ["you're great", "you're awesome", "good job", "well done", "nice",
-                     "you're smart", "love you", "you're the best"],
-        "responses": [
-            "Aww, thank you so much! 😊 You just made my day!",
-            "You're too kind! 💖 I'm here to help anytime!",
-            "Thanks! You're pretty awesome yourself! 🌟",
-        ]
-    },
-
-    # Help with topics
-    "explain": {
-        "patterns": ["explain", "what is", "define", "tell me about", "how does", "meaning of"],
-        "responses": [
-            "I'd be happy to help! 📚 Could you be more specific? For example, try:\n• 'What is AI?'\n• 'What is Python?'\n• 'What is physics?'\n• 'Capital of France'",
-        ]
-    },
-
-    # Time/Date - Dynamic
-    "time": {
-        "patterns": ["time", "what time", "current time", "time now", "what's the time"],
-        "responses": ["__TIME__"]  # Placeholder for dynamic response
-    },
-
-    "date": {
-        "patterns": ["date", "what date", "today", "what day", "today's date", "current date"],
-        "responses": ["__DATE__"]  # Placeholder for dynamic response
-    },
-
-    # Math help
-    "math_help": {
-        "patterns": ["help with math", "math help", "mathematics"],
-        "responses": [
-            "🔢 I can help with math! Try expressions like:\n• '25 + 17'\n• '100 - 45'\n• '12 * 8'\n• '144 / 12'\n• '15 + 3 * 4'\n\nJust type the calculation!",
-        ]
-    },
-
-    # Thanks
-    "thanks": {
-        "patterns": ["thank", "thanks", "thx", "appreciate", "ty", "thank you"],
-        "responses": [
-            "You're welcome! 😊 Happy to help!",
-            "No problem! That's what I'm here for! 🙌",
-            "Anytime! Feel free to ask more questions! 💪",
-            "Glad I could help! 🌟",
-        ]
-    },
-
-    # Goodbye
-    "goodbye": {
-        "patterns": ["bye", "goodbye", "see you", "later", "gotta go", "cya", "gtg", "good night"],
-        "responses": [
-            "Goodbye! 👋 Have a great day!",
-            "See you later! Come back anytime! 😊",
-            "Take care! 🌟 Feel free to chat again soon!",
-            "Bye! It was nice chatting with you! 💬",
-        ]
-    },
-
-    # Yes/No responses
-    "yes": {
-        "patterns": ["yes", "yeah", "yep", "sure", "okay", "ok", "yup", "affirmative"],
-        "responses": [
-            "Great! 👍 What else can I help you with?",
-            "Awesome! Let me know if you need anything else! 😊",
-        ]
-    },
-
-    "no": {
-        "patterns": ["no", "nope", "nah", "negative", "not really"],
-        "responses": [
-            "No problem! Let me know if you change your mind! 😊",
-            "Alright! I'm here if you need anything! 👍",
-        ]
-    },
-
-    # Age question
-    "age": {
-        "patterns": ["how old are you", "your age", "when were you born", "when were you created"],
-        "responses": [
-            "I was just created for this demo! 🎂 But I have the wisdom of thousands of patterns in my knowledge base! Age is just a number anyway, right? 😄",
-        ]
-    },
-
-    # Creator question
-    "creator": {
-        "patterns": ["who made you", "who created you", "who built you", "your creator", "your developer"],
-        "responses": [
-            "I was built by a talented developer for a university presentation! 🎓 I'm a demonstration of smart chatbot technology using Python and Flask!",
-        ]
-    },
-
-    # Help
-    "help": {
-        "patterns": ["help", "what can you do", "commands", "options", "menu"],
-        "responses": [
-            "🤖 *Here's what I can do:*\n\n💬 Chat & Conversation\n🔢 Math calculations\n😄 Tell jokes\n📚 Share fun facts\n⏰ Tell time & date\n🌍 Answer questions\n🧠 General knowledge\n🏀 Sports\n🎵 Music\n🎬 Movies\n🍕 Food\n🏥 Health\n📖 History\n🚀 Space\n🐾 Animals\n\n*Try saying:*\n• 'Tell me a joke'\n• '25 * 4'\n• 'What is AI?'\n• 'Capital of France'\n• 'Tell me about football'\n• 'What is the solar system'",
-        ]
-    },
-
-    # More Capitals
-    "capital_germany": {
-        "patterns": ["capital of germany", "german capital"],
-        "responses": ["🏛️ The capital of Germany is Berlin!"]
-    },
-    "capital_india": {
-        "patterns": ["capital of india", "indian capital"],
-        "responses": ["🏛️ The capital of India is New Delhi!"]
-    },
-    "capital_china": {
-        "patterns": ["capital of china", "chinese capital"],
-        "responses": ["🏛️ The capital of China is Beijing!"]
-    },
-    "capital_brazil": {
-        "patterns": ["capital of brazil", "brazilian capital"],
-        "responses": ["🏛️ The capital of Brazil is Brasília!"]
-    },
-    "capital_egypt": {
-        "patterns": ["capital of egypt", "egyptian capital"],
-        "responses": ["🏛️ The capital of Egypt is Cairo!"]
-    },
-    "capital_south_africa": {
-        "patterns": ["capital of south africa", "south african capital"],
-        "responses": ["🏛️ South Africa has three capitals! Pretoria (executive), Cape Town (legislative), and Bloemfontein (judicial)."]
-    },
-    "capital_ghana": {
-        "patterns": ["capital of ghana", "ghanaian capital"],
-        "responses": ["🏛️ The capital of Ghana is Accra!"]
-    },
-    "capital_kenya": {
-        "patterns": ["capital of kenya", "kenyan capital"],
-        "responses": ["🏛️ The capital of Kenya is Nairobi!"]
-    },
-    "capital_canada": {
-        "patterns": ["capital of canada", "canadian capital"],
-        "responses": ["🏛️ The capital of Canada is Ottawa!"]
-    },
-    "capital_australia": {
-        "patterns": ["capital of australia", "australian capital"],
-        "responses": ["🏛️ The capital of Australia is Canberra! (Not Sydney, which is the largest city.)"]
-    },
-    "capital_russia": {
-        "patterns": ["capital of russia", "russian capital"],
-        "responses": ["🏛️ The capital of Russia is Moscow!"]
-    },
-    "capital_italy": {
-        "patterns": ["capital of italy", "italian capital"],
-        "responses": ["🏛️ The capital of Italy is Rome!"]
-    },
-    "capital_spain": {
-        "patterns": ["capital of spain", "spanish capital"],
-        "responses": ["🏛️ The capital of Spain is Madrid!"]
-    },
-    "capital_turkey": {
-        "patterns": ["capital of turkey", "turkish capital"],
-        "responses": ["🏛️ The capital of Turkey is Ankara! (Not Istanbul, which is the largest city.)"]
-    },
-    "capital_ethiopia": {
-        "patterns": ["capital of ethiopia", "ethiopian capital"],
-        "responses": ["🏛️ The capital of Ethiopia is Addis Ababa!"]
-    },
-    "capital_tanzania": {
-        "patterns": ["capital of tanzania", "tanzanian capital"],
-        "responses": ["🏛️ The capital of Tanzania is Dodoma!"]
-    },
-    "capital_cameroon": {
-        "patterns": ["capital of cameroon", "cameroonian capital"],
-        "responses": ["🏛️ The capital of Cameroon is Yaoundé!"]
-    },
-
-    # Sports
-    "football": {
-        "patterns": ["football", "soccer", "who is the best footballer", "tell me about football",
-                     "world cup", "champions league"],
-        "responses": [
-            "⚽ Football (soccer) is the most popular sport in the world! The FIFA World Cup is the biggest tournament, held every 4 years. Legendary players include Pelé, Maradona, Messi, and Ronaldo.",
-            "⚽ Football is played by over 250 million people in more than 200 countries. The current World Cup holders compete against teams from all continents!",
-            "⚽ The FIFA World Cup started in 1930. Brazil has won it the most times (5). Some of the greatest players ever include Messi, Ronaldo, Pelé, and Maradona!",
-        ]
-    },
-    "basketball": {
-        "patterns": ["basketball", "nba", "who is the best basketball player", "tell me about basketball"],
-        "responses": [
-            "🏀 Basketball was invented by Dr. James Naismith in 1891. The NBA is the top professional league. Legends include Michael Jordan, LeBron James, Kobe Bryant, and Stephen Curry!",
-            "🏀 Basketball is played worldwide! The NBA has 30 teams. Michael Jordan is widely considered the greatest player of all time, with 6 championships!",
-        ]
-    },
-    "cricket": {
-        "patterns": ["cricket", "tell me about cricket", "ipl", "cricket world cup"],
-        "responses": [
-            "🏏 Cricket is hugely popular in countries like India, Australia, England, and Pakistan. The Cricket World Cup is held every 4 years. Legends include Sachin Tendulkar, Don Bradman, and Virat Kohli!",
-        ]
-    },
-    "olympics": {
-        "patterns": ["olympics", "olympic games", "tell me about the olympics"],
-        "responses": [
-            "🏅 The Olympic Games are the world's leading international sporting event. They originated in ancient Greece and were revived in 1896. The Summer and Winter Olympics alternate every 2 years!",
-        ]
-    },
-    "tennis": {
-        "patterns": ["tennis", "tell me about tennis", "grand slam", "wimbledon"],
-        "responses": [
-            "🎾 Tennis has four Grand Slam tournaments: Australian Open, French Open, Wimbledon, and US Open. Legends include Roger Federer, Rafael Nadal, Serena Williams, and Novak Djokovic!",
-        ]
-    },
-
-    # Music
-    "music": {
-        "patterns": ["music", "tell me about music", "what is music", "music genres"],
-        "responses": [
-            "🎵 Music is the art of arranging sounds in time. Major genres include Pop, Rock, Hip-Hop, R&B, Jazz, Classical, Country, and Electronic. Music has been part of every human culture throughout history!",
-            "🎵 Music is a universal language! There are hundreds of genres worldwide, from Afrobeats to K-Pop, from Classical to Reggae. It can influence emotions, boost memory, and bring people together!",
-        ]
-    },
-    "hiphop": {
-        "patterns": ["hip hop", "hiphop", "rap", "rap music", "tell me about rap"],
-        "responses": [
-            "🎤 Hip-Hop originated in the Bronx, New York in the 1970s. It includes rapping, DJing, breakdancing, and graffiti. Influential artists include Tupac, Notorious B.I.G., Jay-Z, Kendrick Lamar, and Eminem!",
-        ]
-    },
-    "afrobeats": {
-        "patterns": ["afrobeats", "afro beats", "nigerian music", "african music"],
-        "responses": [
-            "🥁 Afrobeats is a genre that originated in West Africa, blending African rhythms with pop and hip-hop. Artists like Burna Boy, Wizkid, Davido, and Tiwa Savage have taken it global!",
-        ]
-    },
-
-    # Movies & Entertainment
-    "movies": {
-        "patterns": ["movies", "tell me about movies", "film", "best movies", "cinema"],
-        "responses": [
-            "🎬 Cinema has been entertaining people since the late 1800s! Major film industries include Hollywood (USA), Bollywood (India), and Nollywood (Nigeria). Some all-time greats include The Godfather, Titanic, and The Dark Knight!",
-            "🎬 The film industry generates billions yearly. Hollywood is the largest by revenue, Bollywood produces the most films, and Nollywood is the second largest by volume!",
-        ]
-    },
-    "marvel": {
-        "patterns": ["marvel", "mcu", "avengers", "marvel movies", "superhero"],
-        "responses": [
-            "🦸 Marvel Cinematic Universe (MCU) is the highest-grossing film franchise ever! It includes iconic characters like Iron Man, Spider-Man, Captain America, Thor, and Black Panther. Avengers: Endgame is one of the highest-grossing films of all time!",
-        ]
-    },
-
-    # Food
-    "food": {
-        "patterns": ["food", "tell me about food", "popular food", "best food", "what should i eat"],
-        "responses": [
-            "🍕 Food varies hugely across cultures! Some popular dishes worldwide: Pizza (Italy), Sushi (Japan), Jollof Rice (West Africa), Tacos (Mexico), Biryani (South Asia), and Hamburgers (USA). What's your favorite?",
-            "🍽️ Every culture has its signature dishes! Nigerian Jollof Rice, Italian Pasta, Japanese Ramen, Mexican Burritos, Indian Curry, and Chinese Dim Sum are loved worldwide!",
-        ]
-    },
-    "jollof": {
-        "patterns": ["jollof", "jollof rice", "who makes the best jollof"],
-        "responses": [
-            "🍚 Jollof Rice is a beloved West African dish! Nigeria and Ghana have a friendly rivalry over who makes it best. The truth? Both are delicious! It's made with rice, tomatoes, peppers, and spices.",
-            "🍚 The great Jollof debate! Nigerians say theirs is the best, Ghanaians disagree, and Senegalese remind everyone they invented it. One thing is sure - it's always delicious!",
-        ]
-    },
-
-    # Health
-    "health": {
-        "patterns": ["health", "health tips", "how to stay healthy", "healthy lifestyle"],
-        "responses": [
-            "🏥 Key health tips:\n• Drink plenty of water (8 glasses daily)\n• Exercise regularly (at least 30 min/day)\n• Get 7-8 hours of sleep\n• Eat balanced meals with fruits and vegetables\n• Manage stress through relaxation\n• Avoid excessive sugar and processed foods",
-            "🏥 Staying healthy is simple:\n• Stay hydrated\n• Move your body daily\n• Eat whole foods\n• Sleep well\n• Take breaks from screens\n• Stay socially connected\n• Practice good hygiene",
-        ]
-    },
-    "exercise": {
-        "patterns": ["exercise", "workout", "how to exercise", "fitness", "gym"],
-        "responses": [
-            "💪 Regular exercise is essential! Try:\n• Walking or jogging (30 min/day)\n• Push-ups, squats, and planks\n• Stretching and yoga\n• Swimming or cycling\nStart small and build up gradually. Consistency matters more than intensity!",
-        ]
-    },
-    "mental_health": {
-        "patterns": ["mental health", "anxiety", "stress", "stressed", "overthinking", "worry"],
-        "responses": [
-            "🧠 Mental health matters! Some tips:\n• Talk to someone you trust\n• Take breaks when overwhelmed\n• Practice deep breathing\n• Limit social media\n• Stay physically active\n• Get enough sleep\n\nRemember: It's okay to ask for help. You're not alone! 💚",
-        ]
-    },
-
-    # History
-    "history": {
-        "patterns": ["history", "tell me about history", "world history", "what is history"],
-        "responses": [
-            "📖 History is the study of past events. Key periods include: Ancient civilizations (Egypt, Greece, Rome), the Middle Ages, the Renaissance, the Industrial Revolution, and Modern History. Learning from the past helps us understand the present!",
-        ]
-    },
-    "world_war": {
-        "patterns": ["world war", "ww1", "ww2", "world war 2", "world war 1", "second world war"],
-        "responses": [
-            "📖 World War I (1914-1918) involved the Allied Powers vs Central Powers. World War II (1939-1945) was the deadliest conflict in history, involving most of the world's nations. Together, they shaped the modern world order.",
-        ]
-    },
-    "ancient_egypt": {
-        "patterns": ["ancient egypt", "pyramids", "pharaoh", "egyptian civilization"],
-        "responses": [
-            "🏺 Ancient Egypt was one of the greatest civilizations, lasting over 3,000 years! They built the pyramids, developed hieroglyphics, made advances in medicine and mathematics, and believed in life after death. The Great Pyramid of Giza is one of the Seven Wonders of the Ancient World!",
-        ]
-    },
-
-    # Space & Astronomy
-    "space": {
-        "patterns": ["space", "outer space", "tell me about space", "universe"],
-        "responses": [
-            "🚀 Space is vast and mostly empty! The observable universe is about 93 billion light-years across. It contains billions of galaxies, each with billions of stars. Humans have visited the Moon and sent probes to every planet in our solar system!",
-            "🌌 The universe is about 13.8 billion years old! It contains everything: galaxies, stars, planets, moons, asteroids, and mysterious dark matter. Only about 5% of the universe is made of ordinary matter!",
-        ]
-    },
-    "solar_system": {
-        "patterns": ["solar system", "planets", "how many planets", "tell me about planets"],
-        "responses": [
-            "🪐 Our solar system has 8 planets:\n1. Mercury (closest to Sun)\n2. Venus (hottest planet)\n3. Earth (our home!)\n4. Mars (the red planet)\n5. Jupiter (largest planet)\n6. Saturn (famous rings)\n7. Uranus (tilted sideways)\n8. Neptune (farthest from Sun)\n\nPluto was reclassified as a dwarf planet in 2006!",
-        ]
-    },
-    "moon": {
-        "patterns": ["moon", "tell me about the moon", "earth moon", "lunar"],
-        "responses": [
-            "🌙 The Moon is Earth's only natural satellite! It's about 384,400 km away. Neil Armstrong was the first person to walk on it in 1969. The Moon affects Earth's tides and has no atmosphere!",
-        ]
-    },
-    "sun": {
-        "patterns": ["sun", "tell me about the sun", "how hot is the sun", "what is the sun"],
-        "responses": [
-            "☀️ The Sun is a star at the center of our solar system! It's about 4.6 billion years old, has a surface temperature of about 5,500°C, and is about 109 times the diameter of Earth. It provides the light and energy essential for life on Earth!",
-        ]
-    },
-    "mars": {
-        "patterns": ["mars", "tell me about mars", "red planet", "life on mars"],
-        "responses": [
-            "🔴 Mars is the 4th planet from the Sun, known as the Red Planet due to iron oxide on its surface. It has the tallest volcano (Olympus Mons) and the deepest canyon (Valles Marineris) in the solar system. NASA and SpaceX are working toward sending humans there!",
-        ]
-    },
-
-    # Animals
-    "animals": {
-        "patterns": ["animals", "tell me about animals", "animal facts", "favorite animal"],
-        "responses": [
-            "🐾 The animal kingdom is incredibly diverse! There are over 8.7 million species on Earth. Animals are classified into vertebrates (with backbones) and invertebrates. The blue whale is the largest animal ever, and the bee hummingbird is the smallest bird!",
-        ]
-    },
-    "lion": {
-        "patterns": ["lion", "tell me about lions", "king of the jungle"],
-        "responses": [
-            "🦁 Lions are called the 'King of the Jungle' even though they live in grasslands and savannas! They are the only cats that live in groups (called prides). Male lions are known for their manes, and females do most of the hunting!",
-        ]
-    },
-    "elephant": {
-        "patterns": ["elephant", "tell me about elephants"],
-        "responses": [
-            "🐘 Elephants are the largest land animals! They're incredibly intelligent, have excellent memory, and can live up to 70 years. African elephants have larger ears than Asian elephants. They communicate using sounds, some too low for humans to hear!",
-        ]
-    },
-    "dog": {
-        "patterns": ["dog", "dogs", "tell me about dogs", "man's best friend"],
-        "responses": [
-            "🐕 Dogs have been human companions for over 15,000 years! There are more than 340 recognized breeds. They can understand up to 250 words, their sense of smell is 40 times better than humans, and they can be trained for many jobs including guiding, therapy, and rescue!",
-        ]
-    },
-    "cat": {
-        "patterns": ["cat", "cats", "tell me about cats"],
-        "responses": [
-            "🐱 Cats have been domesticated for about 10,000 years! They sleep 12-16 hours a day, can rotate their ears 180 degrees, and always land on their feet. Ancient Egyptians worshipped cats and considered them sacred!",
-        ]
-    },
-
-    # Computer Science & Technology
-    "internet": {
-        "patterns": ["internet", "what is the internet", "how does the internet work", "www"],
-        "responses": [
-            "🌐 The Internet is a global network of interconnected computers! It was developed from ARPANET in the 1960s. The World Wide Web (WWW) was invented by Tim Berners-Lee in 1989. Today, over 5 billion people use the internet worldwide!",
-        ]
-    },
-    "database": {
-        "patterns": ["database", "what is a database", "explain database", "sql"],
-        "responses": [
-            "🗄️ A database is an organized collection of data stored electronically. Types include relational databases (MySQL, PostgreSQL) and NoSQL databases (MongoDB). SQL (Structured Query Language) is the standard language for managing relational databases!",
-        ]
-    },
-    "html": {
-        "patterns": ["html", "what is html", "explain html"],
-        "responses": [
-            "🌐 HTML (HyperText Markup Language) is the standard language for creating web pages! It uses tags like <h1>, <p>, and <div> to structure content. Along with CSS and JavaScript, it forms the foundation of web development!",
-        ]
-    },
-    "javascript": {
-        "patterns": ["javascript", "what is javascript", "explain javascript", "js"],
-        "responses": [
-            "💛 JavaScript is one of the most popular programming languages! It was created in just 10 days in 1995. Originally for web browsers, it now runs everywhere - servers (Node.js), mobile apps, and even robots. It powers interactive features on almost every website!",
-        ]
-    },
-    "cybersecurity": {
-        "patterns": ["cybersecurity", "cyber security", "hacking", "what is cybersecurity"],
-        "responses": [
-            "🔒 Cybersecurity is the practice of protecting systems, networks, and data from digital attacks. Key areas include network security, application security, and data protection. Tips: Use strong passwords, enable 2FA, keep software updated, and be cautious with links!",
-        ]
-    },
-
-    # Mathematics Concepts
-    "algebra": {
-        "patterns": ["algebra", "what is algebra", "explain algebra"],
-        "responses": [
-            "🔢 Algebra is a branch of mathematics dealing with symbols and rules for manipulating them. It uses letters (like x and y) to represent unknown values. For example, in the equation 2x + 3 = 7, solving for x gives x = 2!",
-        ]
-    },
-    "geometry": {
-        "patterns": ["geometry", "what is geometry", "explain geometry", "shapes"],
-        "responses": [
-            "📐 Geometry is the branch of mathematics that deals with shapes, sizes, and properties of space. It covers points, lines, angles, surfaces, and solids. Key shapes include triangles, circles, squares, and cubes. The Greek mathematician Euclid is called the 'Father of Geometry'!",
-        ]
-    },
-    "pi": {
-        "patterns": ["what is pi", "value of pi", "pi number"],
-        "responses": [
-            "🥧 Pi (π) is a mathematical constant representing the ratio of a circle's circumference to its diameter. Its value is approximately 3.14159. It's an irrational number, meaning its decimal digits go on forever without repeating!",
-        ]
-    },
-
-    # Environment
-    "climate_change": {
-        "patterns": ["climate change", "global warming", "greenhouse effect", "carbon emissions"],
-        "responses": [
-            "🌍 Climate change refers to long-term shifts in global temperatures and weather patterns. Human activities, especially burning fossil fuels, have been the main driver since the 1800s. Effects include rising sea levels, extreme weather, and loss of biodiversity. Everyone can help by reducing energy use and supporting sustainable practices!",
-        ]
-    },
-    "renewable_energy": {
-        "patterns": ["renewable energy", "solar energy", "wind energy", "clean energy", "green energy"],
-        "responses": [
-            "🌱 Renewable energy comes from natural sources that replenish themselves:\n• Solar - energy from sunlight\n• Wind - energy from air movement\n• Hydro - energy from flowing water\n• Geothermal - energy from Earth's heat\n• Biomass - energy from organic materials\n\nThey produce little to no greenhouse gas emissions!",
-        ]
-    },
-
-    # Languages
-    "languages": {
-        "patterns": ["languages", "most spoken languages", "how many languages", "world languages"],
-        "responses": [
-            "🗣️ There are about 7,000 languages spoken worldwide! The most spoken by total speakers:\n1. English (~1.5 billion)\n2. Mandarin Chinese (~1.1 billion)\n3. Hindi (~600 million)\n4. Spanish (~550 million)\n5. French (~300 million)\n\nAbout 40% of languages are endangered with fewer than 1,000 speakers!",
-        ]
-    },
-
-    # Currency
-    "currency": {
-        "patterns": ["currency", "money", "currencies of the world", "what is currency"],
-        "responses": [
-            "💰 Currency is a system of money used in a country. Major currencies include:\n• US Dollar (USD) 🇺🇸\n• Euro (EUR) 🇪🇺\n• British Pound (GBP) 🇬🇧\n• Japanese Yen (JPY) 🇯🇵\n• Nigerian Naira (NGN) 🇳🇬\n• Chinese Yuan (CNY) 🇨🇳\n\nThe US Dollar is the world's primary reserve currency!",
-        ]
-    },
-    "bitcoin": {
-        "patterns": ["bitcoin", "crypto", "cryptocurrency", "blockchain"],
-        "responses": [
-            "₿ Bitcoin is the first and most well-known cryptocurrency, created in 2009 by the mysterious Satoshi Nakamoto. It uses blockchain technology - a decentralized digital ledger. Other popular cryptocurrencies include Ethereum, Solana, and Litecoin!",
-        ]
-    },
-
-    # Education
-    "education": {
-        "patterns": ["education", "importance of education", "why is education important", "learning"],
-        "responses": [
-            "📚 Education is the process of acquiring knowledge, skills, and values. It empowers individuals, reduces poverty, promotes equality, and drives innovation. Formal education typically includes primary, secondary, and tertiary levels. Lifelong learning is key to personal and professional growth!",
-        ]
-    },
-    "university": {
-        "patterns": ["university", "college", "higher education", "best universities"],
-        "responses": [
-            "🎓 Universities provide higher education and research opportunities. Some of the world's top universities include MIT, Stanford, Harvard, Oxford, and Cambridge. Africa has great institutions too, including University of Cape Town, University of Lagos, and Makerere University!",
-        ]
-    },
-
-    # Social Media
-    "social_media": {
-        "patterns": ["social media", "instagram", "twitter", "tiktok", "facebook", "snapchat"],
-        "responses": [
-            "📱 Social media platforms connect billions of people:\n• Facebook/Meta - largest social network\n• Instagram - photo and video sharing\n• Twitter/X - short-form text updates\n• TikTok - short video content\n• Snapchat - disappearing messages\n• LinkedIn - professional networking\n\nTip: Use social media mindfully and protect your privacy!",
-        ]
-    },
-
-    # Riddles
-    "riddle": {
-        "patterns": ["riddle", "tell me a riddle", "give me a riddle", "brain teaser"],
-        "responses": [
-            "🧩 Riddle: I have cities, but no houses. I have mountains, but no trees. I have water, but no fish. What am I?\n\nAnswer: A map!",
-            "🧩 Riddle: The more you take, the more you leave behind. What am I?\n\nAnswer: Footsteps!",
-            "🧩 Riddle: I speak without a mouth and hear without ears. I have no body, but I come alive with the wind. What am I?\n\nAnswer: An echo!",
-            "🧩 Riddle: What has keys but no locks, space but no room, and you can enter but can't go inside?\n\nAnswer: A keyboard!",
-            "🧩 Riddle: I'm tall when I'm young and short when I'm old. What am I?\n\nAnswer: A candle!",
-            "🧩 Riddle: What can travel around the world while staying in a corner?\n\nAnswer: A stamp!",
-        ]
-    },
-
-    # Quotes
-    "quote": {
-        "patterns": ["quote", "famous quote", "inspirational quote", "give me a quote", "wise words"],
-        "responses": [
-            "📜 'The only way to do great work is to love what you do.' - Steve Jobs",
-            "📜 'Education is the most powerful weapon which you can use to change the world.' - Nelson Mandela",
-            "📜 'In the middle of every difficulty lies opportunity.' - Albert Einstein",
-            "📜 'It always seems impossible until it's done.' - Nelson Mandela",
-            "📜 'The future belongs to those who believe in the beauty of their dreams.' - Eleanor Roosevelt",
-            "📜 'Success is not final, failure is not fatal: it is the courage to continue that counts.' - Winston Churchill",
-            "📜 'Be the change that you wish to see in the world.' - Mahatma Gandhi",
-            "📜 'Knowledge is power.' - Francis Bacon",
-        ]
-    },
+# The knowledge base itself lives in knowledge_base.json (KB_PATH). It is
+# loaded, together with its pattern index, at the end of the PATTERN INDEX section.
+
+# Sentiment lexicon: word -> weight (strong words count double)
+SENTIMENT_LEXICON = {
+    # Positive
+    "good": 1, "great": 1, "awesome": 2, "excellent": 2, "happy": 1, "love": 2, "loved": 2,
+    "loving": 2, "loves": 2, "best": 2, "thanks": 1, "thank": 1, "thx": 1, "amazing": 2,
+    "wonderful": 2, "fantastic": 2, "brilliant": 2, "perfect": 2, "nice": 1, "cool": 1,
+    "super": 1, "beautiful": 1, "excited": 1, "glad": 1, "pleased": 1,
+    # Negative
+    "bad": -1, "terrible": -2, "awful": -2, "hate": -2, "hated": -2, "hates": -2, "worst": -2,
+    "sad": -1, "angry": -1, "disappointed": -1, "horrible": -2, "disgusting": -2,
+    "annoying": -1, "annoyed": -1, "frustrated": -1, "upset": -1, "unhappy": -1,
+    "depressed": -2, "boring": -1, "bored": -1, "stupid": -1, "ugly": -1,
+}
 
-    # Continent info
-    "africa": {
-        "patterns": ["africa", "tell me about africa", "african continent"],
-        "responses": [
-            "🌍 Africa is the second-largest and second-most populous continent with 54 countries! It's home to the Sahara (largest hot desert), the Nile (longest river), and incredible wildlife. Africa has a young population and is rich in natural resources, culture, and history!",
-        ]
-    },
-    "europe": {
-        "patterns": ["europe", "tell me about europe", "european continent"],
-        "responses": [
-            "🌍 Europe is the second-smallest continent with 44 countries! It's known for its rich history, diverse cultures, and influential contributions to art, science, and philosophy. The European Union (EU) is a political and economic union of 27 member states!",
-        ]
-    },
-    "asia": {
-        "patterns": ["asia", "tell me about asia", "asian continent"],
-        "responses": [
-            "🌏 Asia is the largest and most populous continent! It covers about 30% of Earth's land area and is home to over 4.5 billion people. It includes diverse countries from Japan to India to Saudi Arabia, and has some of the world's oldest civilizations!",
-        ]
-    },
+# Words that flip the sentiment of the next few words ("not good", "never happy")
+NEGATIONS = frozenset(["not", "no", "never", "dont", "don't", "isnt", "isn't", "wasnt", "wasn't",
+                       "arent", "aren't", "cant", "can't", "wont", "won't", "hardly"])
+NEGATION_WINDOW = 3
+# A negation never reaches past the end of its clause ("no worries, thanks!")
+CLAUSE_ENDINGS = (",", ".", "!", "?", ";")
 
-    # Nigeria specific
-    "nigeria": {
-        "patterns": ["nigeria", "tell me about nigeria", "naija"],
-        "responses": [
-            "🇳🇬 Nigeria is the most populous country in Africa with over 200 million people! It has 36 states and the FCT (Abuja). Nigeria has over 250 ethnic groups, with Hausa, Yoruba, and Igbo being the largest. It's known for its oil industry, Nollywood, and Afrobeats music!",
-        ]
-    },
+# Follow-up words whose reply depends on the user's conversation history
+CONTEXT_WORDS = frozenset(["another", "more", "again"])
 
-    # Greetings in other languages
-    "greetings_languages": {
-        "patterns": ["hello in other languages", "how to say hello", "greetings in different languages"],
-        "responses": [
-            "👋 Hello in different languages:\n• Spanish: Hola\n• French: Bonjour\n• German: Hallo\n• Italian: Ciao\n• Portuguese: Olá\n• Arabic: Marhaba\n• Chinese: Nǐ hǎo\n• Japanese: Konnichiwa\n• Yoruba: Bawo\n• Hausa: Sannu\n• Igbo: Ndewo\n• Swahili: Jambo",
-        ]
-    },
-}
+# Whole words that mark a question, greeting or farewell
+QUESTION_WORDS = frozenset(["what", "who", "where", "when", "why", "how",
+                            "what's", "whats", "who's", "where's", "when's", "why's", "how's", "hows"])
+GREETING_WORDS = frozenset(["hello", "hi", "hey"])
+FAREWELL_WORDS = frozenset(["bye", "goodbye", "later"])
 
 # Common misspellings dictionary
 SPELLING_CORRECTIONS = {
@@ -813,158 +178,2266 @@ SPELLING_CORRECTIONS = {
 }
 
 
+def load_word_list(path):
+    """Lowercase words from a one-word-per-line file (empty if it can't be read)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return frozenset(line.strip().lower() for line in f if line.strip())
+    except OSError:
+        return frozenset()
+
+
+# Real words are never "corrected" into a KB word ("plants" is not a typo of "planets")
+ENGLISH_WORDS = load_word_list(SPELLING_WORDS_PATH)
+
+# Inflections stripped to find a word's base form: (suffix, ending put back)
+ENGLISH_SUFFIXES = (
+    ("ies", "y"), ("ied", "y"), ("es", ""), ("s", ""), ("ed", ""), ("ed", "e"), ("ing", ""), ("ing", "e"),
+    ("ly", ""), ("er", ""), ("er", "e"), ("est", ""), ("est", "e"), ("ness", ""), ("ment", ""), ("ful", ""),
+)
+
+
+def is_english_word(word):
+    """Whether word, or its base form ("grows", "stopped", "happier"), is a common English word"""
+    if word in ENGLISH_WORDS:
+        return True
+    for suffix, ending in ENGLISH_SUFFIXES:
+        if word.endswith(suffix) and len(word) > len(suffix) + 1:
+            base = word[:-len(suffix)]
+            if base + ending in ENGLISH_WORDS:
+                return True
+            # Doubled final consonant: "stopped", "running", "bigger"
+            if not ending and base[-1] == base[-2] and base[:-1] in ENGLISH_WORDS:
+                return True
+    return False
+
+
+# ==================================================================
+# RESPONSE TEMPLATES - KB replies compiled once, dynamic ones rendered lazily
+# ==================================================================
+
+class ClockResponse:
+    """A reply showing the current WAT time or date, formatted at most once per period
+
+    The text is reused until the next period boundary (the next minute for the
+    time, local midnight for the date), which is also how long it may be cached.
+    """
+
+    def __init__(self, template, period):
+        self.template = template
+        self.period = period
+        self._offset = WAT.utcoffset(None).total_seconds()
+        self._text = None
+        self._expires = 0.0
+
+    def render(self):
+        now = time.time()
+        if now >= self._expires:
+            self._text = self.template.format(datetime.fromtimestamp(now, WAT))
+            local_boundary = ((now + self._offset) // self.period + 1) * self.period
+            self._expires = local_boundary - self._offset
+        return self._text
+
+    def ttl(self):
+        """Seconds until the last rendered text goes stale"""
+        return max(0.0, self._expires - time.time())
+
+
+# Placeholder replies in KNOWLEDGE_BASE and the template each one compiles to.
+# New dynamic answers only need an entry here.
+DYNAMIC_RESPONSES = {
+    "__TIME__": lambda: ClockResponse("⏰ The current time is: {:%I:%M %p}", 60),
+    "__DATE__": lambda: ClockResponse("📅 Today is: {:%B %d, %Y (%A)}", 24 * 60 * 60),
+}
+
+
+def compile_response(response):
+    """A static reply stays a plain string; a placeholder becomes its template"""
+    factory = DYNAMIC_RESPONSES.get(response)
+    return factory() if factory is not None else response
+
+
+def render_response(template):
+    return template if type(template) is str else template.render()
+
+
+# ==================================================================
+# SHARED BUFFERS - Read-only index data addressed by offsets
+# ==================================================================
+#
+# The largest indexes are kept as flat bytes instead of Python objects. The
+# knowledge base snapshot stores those bytes and every worker maps them
+# read-only (mmap), so all workers share one copy through the page cache.
+
+class SharedBuffer:
+    """Read-only bytes (in memory, or a slice of the mapped snapshot) viewed as bytes and uint32s"""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.uints = self.view.cast("I")
+
+    def __len__(self):
+        return len(self.view)
+
+    def __reduce__(self):
+        # The snapshot stores buffers by reference (see KnowledgeBaseLoader);
+        # any other pickle gets a copy of the bytes
+        return (SharedBuffer, (self.view.tobytes(),))
+
+
+def pack_uints(data, values):
+    """Append uint32 values to a bytearray; returns their index in uint32 units"""
+    index = len(data) // 4
+    data += array("I", values).tobytes()
+    return index
+
+
+def pad_to_uint(data):
+    data += b"\0" * (-len(data) % 4)
+
+
+class StringTable:
+    """Read-only sequence of strings stored as UTF-8 in a SharedBuffer
+
+    Layout: count, count + 1 offsets (uint32), then the encoded strings.
+    """
+
+    def __init__(self, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = [0]
+        for item in encoded:
+            offsets.append(offsets[-1] + len(item))
+        data = bytearray()
+        pack_uints(data, [len(encoded)])
+        pack_uints(data, offsets)
+        data += b"".join(encoded)
+        pad_to_uint(data)
+        self.__setstate__(SharedBuffer(bytes(data)))
+
+    def __getstate__(self):
+        return self.shared
+
+    def __setstate__(self, shared):
+        self.shared = shared
+        self.count = shared.uints[0]
+        self.offsets = shared.uints[1:self.count + 2]
+        self.start = 4 * (self.count + 2)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        start = self.start + self.offsets[position]
+        end = self.start + self.offsets[position + 1]
+        return str(self.shared.view[start:end], "utf-8")
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+
+class SharedTable:
+    """Read-only hash table from strings to non-empty runs of uint32s, stored in a SharedBuffer
+
+    Open addressing with linear probing. Slots are hashed with crc32, which
+    unlike hash() is the same in every process. Layout: slot count, index of
+    the values, slots of (key offset, key length, values index, value count),
+    keys, values.
+    """
+
+    def __init__(self, mapping):
+        slot_count = 8
+        while slot_count < 2 * len(mapping):
+            slot_count *= 2
+        mask = slot_count - 1
+        slots = array("I", [0]) * (4 * slot_count)
+        keys = bytearray()
+        values = array("I")
+        for key, run in mapping.items():
+            encoded = key.encode("utf-8")
+            slot = zlib.crc32(encoded) & mask
+            while slots[4 * slot + 3]:
+                slot = (slot + 1) & mask
+            slots[4 * slot:4 * slot + 4] = array("I", [len(keys), len(encoded), len(values), len(run)])
+            keys += encoded
+            values.extend(run)
+
+        data = bytearray()
+        pack_uints(data, [slot_count, 0])
+        data += slots.tobytes()
+        data += keys
+        pad_to_uint(data)
+        data[4:8] = array("I", [len(data) // 4]).tobytes()
+        data += values.tobytes()
+        self.__setstate__(SharedBuffer(bytes(data)))
+
+    def __getstate__(self):
+        return self.shared
+
+    def __setstate__(self, shared):
+        self.shared = shared
+        slot_count, self.values = shared.uints[0], shared.uints[1]
+        self.mask = slot_count - 1
+        self.keys = 8 + 16 * slot_count
+
+    def get(self, key, default=None):
+        """The uint32 run stored under key (a memoryview), or default"""
+        encoded = key.encode("utf-8")
+        view = self.shared.view
+        uints = self.shared.uints
+        slot = zlib.crc32(encoded) & self.mask
+        while True:
+            base = 2 + 4 * slot
+            count = uints[base + 3]
+            if not count:
+                return default
+            length = uints[base + 1]
+            if length == len(encoded):
+                start = self.keys + uints[base]
+                if view[start:start + length] == encoded:
+                    start = self.values + uints[base + 2]
+                    return uints[start:start + count]
+            slot = (slot + 1) & self.mask
+
+
+# ==================================================================
+# PATTERN INDEX - Built once at startup, rebuilt on KB reload
+# ==================================================================
+
+SHORT_PATTERN_LENGTH = 5  # Patterns this short must match as whole words
+
+
+class PatternAutomaton:
+    """Aho-Corasick automaton that finds every pattern in one pass over the text"""
+
+    def __init__(self, patterns):
+        # Patterns are given in priority order; outputs hold their ranks
+        self.goto = [{}]
+        self.fail = [0]
+        outputs = [[]]
+
+        for rank, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(rank)
+
+        # Breadth-first pass to set failure links and merge suffix outputs
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(ch, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                outputs[next_state].extend(outputs[self.fail[next_state]])
+                queue.append(next_state)
+
+        # Only the best rank ending at each state matters
+        self.best = [min(out) if out else None for out in outputs]
+
+    def best_rank(self, text, best=None):
+        """Return the lowest pattern rank found in text (or best if lower)"""
+        goto, fail, best_at = self.goto, self.fail, self.best
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            rank = best_at[state]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        return best
+
+
+class FuzzyIndex:
+    """Character index that shortlists patterns before difflib scoring"""
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        lowered = [pattern.lower() for pattern in self.patterns]
+        self.lowered = StringTable(lowered)
+        self.lengths = tuple(len(pattern) for pattern in lowered)
+
+        # char -> pattern position, occurrences of char in pattern, position, ...
+        postings = {}
+        for position, pattern in enumerate(lowered):
+            for ch, count in Counter(pattern).items():
+                postings.setdefault(ch, []).extend((position, count))
+        self.postings = SharedTable(postings)
+
+    def best_match(self, message, threshold=0.7):
+        """Same result as scoring every pattern with SequenceMatcher.ratio()"""
+        message_lower = message.lower()
+        message_len = len(message_lower)
+
+        # Shared characters (as a multiset) bound the matching blocks
+        # SequenceMatcher can find, so 2 * shared / total bounds ratio()
+        shared = [0] * len(self.patterns)
+        for ch, count in Counter(message_lower).items():
+            run = self.postings.get(ch)
+            if run is None:
+                continue
+            pairs = iter(run)
+            for position, pattern_count in zip(pairs, pairs):
+                shared[position] += count if count < pattern_count else pattern_count
+
+        candidates = []
+        for position, common in enumerate(shared):
+            if common:
+                bound = 2.0 * common / (message_len + self.lengths[position])
+                if bound >= threshold:
+                    candidates.append((-bound, position))
+        candidates.sort()
+
+        best_position = None
+        best_score = 0
+        for negative_bound, position in candidates:
+            if -negative_bound < best_score:
+                break
+            ratio = difflib.SequenceMatcher(None, message_lower, self.lowered[position]).ratio()
+            if ratio < threshold:
+                continue
+            # Ties go to the earliest pattern, as in the linear scan
+            if ratio > best_score or (ratio == best_score and best_position is not None
+                                      and position < best_position):
+                best_score = ratio
+                best_position = position
+
+        if best_position is None:
+            return None, 0
+        return self.patterns[best_position], best_score
+
+
+def validate_knowledge_base(knowledge_base):
+    """Raise ValueError unless every category has patterns and at least one reply, all strings"""
+    if not isinstance(knowledge_base, dict):
+        raise ValueError("knowledge base must be an object of categories")
+    for category, data in knowledge_base.items():
+        if not isinstance(data, dict):
+            raise ValueError(f"category {category!r} must be an object")
+        patterns = data.get("patterns")
+        if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+            raise ValueError(f"category {category!r}: patterns must be a list of strings")
+        responses = data.get("responses")
+        if (not isinstance(responses, list) or not responses
+                or not all(isinstance(response, str) for response in responses)):
+            raise ValueError(f"category {category!r}: responses must be a non-empty list of strings")
+
+
+class PatternIndex:
+    """Precomputed lookup structures over all knowledge base patterns"""
+
+    def __init__(self, knowledge_base):
+        validate_knowledge_base(knowledge_base)
+        self.knowledge_base = knowledge_base
+        pairs = []
+        for category, data in knowledge_base.items():
+            for pattern in data["patterns"]:
+                pairs.append((pattern, category))
+
+        # Patterns in knowledge base order, used by the fuzzy pass
+        self.patterns = tuple(pattern for pattern, _ in pairs)
+        self.fuzzy = FuzzyIndex(self.patterns)
+        self.pattern_to_category = {}
+        for pattern, category in pairs:
+            self.pattern_to_category[pattern] = category
+
+        # Sort by length (longest first) so specific patterns like
+        # "capital of canada" match before generic "capital of"
+        pairs.sort(key=lambda x: len(x[0]), reverse=True)
+        self.pairs = tuple(pairs)
+
+        # Long patterns are plain substring matches, found by the automaton.
+        # They all outrank short patterns, which only need checking on a miss.
+        long_count = sum(1 for pattern, _ in self.pairs if len(pattern) > SHORT_PATTERN_LENGTH)
+        self.automaton = PatternAutomaton([pattern for pattern, _ in self.pairs[:long_count]])
+
+        # For short patterns (5 chars or less), require whole word match.
+        # This prevents "cat" matching inside "education", "no" inside "information", etc.
+        # One compiled alternation (longest first) replaces a regex per pattern;
+        # the lookahead lets overlapping candidates all be seen in a single scan.
+        self.short_rank = {}
+        for rank in range(long_count, len(self.pairs)):
+            self.short_rank.setdefault(self.pairs[rank][0], rank)
+        self.short_regex = None
+        if self.short_rank:
+            alternation = "|".join(re.escape(pattern) for pattern in self.short_rank if pattern)
+            self.short_regex = re.compile(r'(?=\b(' + alternation + r')\b)')
+
+        # Misspellings are corrected towards words that appear in patterns;
+        # words from the replies are known English and left alone
+        targets = [word for pattern in self.patterns for word in pattern.split()]
+        for correction in SPELLING_CORRECTIONS.values():
+            targets.extend(correction.split())
+        known = set()
+        for data in knowledge_base.values():
+            for response in data["responses"]:
+                known.update(tokenize(response))
+        self.spelling = SpellingIndex(targets, known)
+
+        # Every category's replies, compiled once
+        self.responses = {
+            category: tuple(compile_response(response) for response in data["responses"])
+            for category, data in knowledge_base.items()
+        }
+
+        # Replies that a follow-up ("another one") can continue, by topic
+        self.response_topic = {}
+        self.topic_category = {}
+        for category, data in knowledge_base.items():
+            topic = data.get("follow_up")
+            if topic:
+                self.topic_category[topic] = category
+                for response in data["responses"]:
+                    self.response_topic[response] = topic
+
+        # Per-pattern matchers for the reference linear scan, compiled on first use
+        self._matchers = None
+
+    def match(self, *texts):
+        """Return the category of the longest pattern found in any of the texts"""
+        unique_texts = dict.fromkeys(texts)
+        best = None
+        for text in unique_texts:
+            best = self.automaton.best_rank(text, best)
+        if best is None and self.short_regex is not None:
+            short_rank = self.short_rank
+            for text in unique_texts:
+                for found in self.short_regex.finditer(text):
+                    rank = short_rank[found.group(1)]
+                    if best is None or rank < best:
+                        best = rank
+        return self.pairs[best][1] if best is not None else None
+
+    @property
+    def matchers(self):
+        if self._matchers is None:
+            self._matchers = tuple(
+                (pattern, category,
+                 re.compile(r'\b' + re.escape(pattern) + r'\b').search
+                 if len(pattern) <= SHORT_PATTERN_LENGTH else None)
+                for pattern, category in self.pairs
+            )
+        return self._matchers
+
+    def match_linear(self, *texts):
+        """Reference implementation: try every pattern in priority order"""
+        for pattern, category, search in self.matchers:
+            if search is not None:
+                for text in texts:
+                    if search(text):
+                        return category
+            else:
+                for text in texts:
+                    if pattern in text:
+                        return category
+        return None
+
+
+def tokenize(text):
+    """Lowercase words with surrounding punctuation removed ("don't" is kept whole)"""
+    return [chunk.strip(string.punctuation) for chunk in text.lower().split()]
+
+
+def word_deletes(word, max_distance):
+    """The word plus every string reachable by deleting up to max_distance characters"""
+    found = {word}
+    frontier = [word]
+    for _ in range(max_distance):
+        next_frontier = []
+        for current in frontier:
+            for position in range(len(current)):
+                variant = current[:position] + current[position + 1:]
+                if variant not in found:
+                    found.add(variant)
+                    next_frontier.append(variant)
+        frontier = next_frontier
+    return found
+
+
+def edit_distance(a, b, limit):
+    """Edit distance counting adjacent swaps as one edit; limit + 1 once it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous_row[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_row, row = row, current
+    return row[-1]
+
+
+class SpellingIndex:
+    """SymSpell-style corrector over the knowledge base vocabulary
+
+    Every vocabulary word is stored under each string reachable by deleting up
+    to SPELLING_MAX_DISTANCE characters. A typo is looked up through its own
+    deletes, so the cost depends on the word's length, not the vocabulary size.
+    """
+
+    def __init__(self, targets, known=()):
+        self.frequency = Counter(targets)
+        # Words that are never corrected: the targets plus other words the bot uses
+        self.known = set(known)
+        self.known.update(self.frequency)
+        # delete variant -> positions in self.words of the words it came from
+        self.words = tuple(self.frequency)
+        deletes = {}
+        for position, word in enumerate(self.words):
+            for variant in word_deletes(word, SPELLING_MAX_DISTANCE):
+                deletes.setdefault(variant, []).append(position)
+        self.deletes = SharedTable(deletes)
+        self.memo = {}
+
+    def correct(self, word):
+        """Closest vocabulary word (fewest edits, then most common), or None
+
+        Common English words ("plants", "match") are left alone even when a
+        vocabulary word is one edit away.
+        """
+        if (word in self.known or not word.isalpha()
+                or not SPELLING_MIN_LENGTH <= len(word) <= SPELLING_MAX_LENGTH):
+            return None
+        try:
+            return self.memo[word]
+        except KeyError:
+            pass
+
+        best = None if is_english_word(word) else self._closest(word)
+        if len(self.memo) >= SPELLING_MEMO_SIZE:
+            self.memo.clear()
+        self.memo[word] = best
+        return best
+
+    def _closest(self, word):
+        limit = 1 if len(word) < 8 else SPELLING_MAX_DISTANCE
+        best = None
+        best_key = None
+        seen = set()
+        words = self.words
+        for variant in word_deletes(word, limit):
+            for candidate in map(words.__getitem__, self.deletes.get(variant, ())):
+                # Typos rarely hit the first letter; requiring it avoids "there" -> "where"
+                if candidate in seen or candidate[0] != word[0]:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(word, candidate, limit)
+                if distance <= limit:
+                    key = (distance, -self.frequency[candidate], candidate)
+                    if best_key is None or key < best_key:
+                        best, best_key = candidate, key
+        return best
+
+
+# Snapshot file: header, shared buffers (mapped by every worker), then two
+# pickles: the stamp and the PatternIndex, which refers to the buffers by offset
+SNAPSHOT_HEADER = struct.Struct("<8sQ")  # magic, offset of the pickles
+SNAPSHOT_MAGIC = b"KBSNAP2\n"
+
+# Classes a snapshot may contain, whether it was written by "chat" or "__main__"
+SNAPSHOT_CLASSES = {"PatternIndex", "PatternAutomaton", "FuzzyIndex", "SpellingIndex", "ClockResponse",
+                    "StringTable", "SharedTable", "SharedBuffer"}
+SNAPSHOT_GLOBALS = {("builtins", "set"), ("builtins", "frozenset"), ("collections", "Counter"), ("re", "_compile")}
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """Rebuilds only the knowledge base classes and plain containers"""
+
+    def __init__(self, file, mapped=None):
+        super().__init__(file)
+        self.mapped = mapped
+
+    def persistent_load(self, pid):
+        kind, offset, length = pid
+        if kind != "shared" or self.mapped is None:
+            raise pickle.UnpicklingError(f"unexpected persistent id {pid!r}")
+        return SharedBuffer(self.mapped[offset:offset + length])
+
+    def find_class(self, module, name):
+        if name in SNAPSHOT_CLASSES and module in ("__main__", "chat", __name__):
+            return globals()[name]
+        if (module, name) in SNAPSHOT_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a knowledge base snapshot")
+
+
+class KnowledgeBaseLoader:
+    """Loads the knowledge base JSON through a compiled snapshot and notices edits
+
+    The snapshot is a pickle of the PatternIndex (which holds the knowledge base)
+    stamped with the JSON file's and this module's modification times. The
+    index's shared buffers are stored beside the pickle and mapped read-only
+    on load, so workers share them. A stale or unreadable snapshot is simply
+    rebuilt from the JSON.
+    """
+
+    def __init__(self, path=KB_PATH, snapshot_path=KB_SNAPSHOT_PATH, check_interval=KB_CHECK_INTERVAL):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.check_interval = check_interval
+        self.stamp = None
+        self.loaded_from = None  # "snapshot" or "source"
+        self.load_ms = None
+        self.reloads = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+
+    def load(self):
+        """The PatternIndex for the current JSON file"""
+        started = time.perf_counter()
+        stamp = self._stamp()
+        index = self._read_snapshot(stamp)
+        loaded_from = "snapshot"
+        if index is None:
+            with open(self.path, encoding="utf-8") as f:
+                index = PatternIndex(json.load(f))
+            # Read it back so this process maps the shared buffers like every other
+            if self._write_snapshot(stamp, index):
+                index = self._read_snapshot(stamp) or index
+            loaded_from = "source"
+        self.stamp = stamp
+        self.loaded_from = loaded_from
+        self.load_ms = round((time.perf_counter() - started) * 1000, 2)
+        return index
+
+    def reload(self, log=None):
+        """Load the JSON again; None if a reload is already running or the file is invalid
+
+        A failure is reported through log(message), by default log_knowledge_base.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            index = self.load()
+            self.reloads += 1
+            return index
+        except Exception as error:
+            # Whatever went wrong, keep serving the previous version and don't
+            # retry until the file changes again
+            self.errors += 1
+            try:
+                self.stamp = self._stamp()
+            except OSError:
+                pass
+            (log or log_knowledge_base)(f"reload of {self.path} failed, keeping the previous version: {error}")
+            return None
+        finally:
+            self._lock.release()
+
+    def changed(self):
+        """True if the JSON file changed since it was loaded (checked every check_interval seconds)"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        try:
+            return self._stamp() != self.stamp
+        except OSError:
+            return False
+
+    def stats(self):
+        """Status for /health"""
+        return {
+            "path": self.path,
+            "loaded_from": self.loaded_from,
+            "load_ms": self.load_ms,
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
+
+    def _stamp(self):
+        source = os.stat(self.path)
+        code = os.stat(os.path.abspath(__file__))
+        return (source.st_mtime_ns, source.st_size, code.st_mtime_ns, sys.hexversion, sys.byteorder)
+
+    def _read_snapshot(self, stamp):
+        # Unpickling creates many small objects; pausing the collector roughly halves the time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                magic, pickle_offset = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+                if magic != SNAPSHOT_MAGIC:
+                    return None
+                f.seek(pickle_offset)
+                # Two pickles: the stamp, then the index (each needs its own unpickler)
+                if SnapshotUnpickler(f).load() != stamp:
+                    return None
+                mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                return SnapshotUnpickler(f, mapped).load()
+        except Exception:
+            # Missing, stale, truncated or foreign: rebuild from the JSON instead
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _write_snapshot(self, stamp, index):
+        """Write the snapshot; returns False if it could not be written"""
+        # Shared buffers go into the file's buffer area; the pickle keeps their offsets
+        buffers = bytearray()
+        placed = {}
+
+        def persistent_id(obj):
+            if type(obj) is not SharedBuffer:
+                return None
+            if id(obj) not in placed:
+                buffers.extend(b"\0" * (-len(buffers) % 8))
+                placed[id(obj)] = ("shared", SNAPSHOT_HEADER.size + len(buffers), len(obj))
+                buffers.extend(obj.view)
+            return placed[id(obj)]
+
+        body = io.BytesIO()
+        pickle.dump(stamp, body, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler = pickle.Pickler(body, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        try:
+            pickler.dump(index)
+        except pickle.PicklingError:
+            # e.g. this module was loaded under a name pickle can't import
+            return False
+
+        # Write to a temporary file and rename, so readers never see half a snapshot
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".kb-", suffix=".tmp")
+        except OSError:
+            return False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_HEADER.size + len(buffers)))
+                f.write(buffers)
+                f.write(body.getbuffer())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.snapshot_path)
+            return True
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return False
+
+
+def install_pattern_index(index):
+    """Swap in a new index; requests already running keep the one they started with"""
+    global KNOWLEDGE_BASE, PATTERN_INDEX
+    PATTERN_INDEX = index
+    KNOWLEDGE_BASE = index.knowledge_base
+    return index
+
+
+def rebuild_pattern_index():
+    """Rebuild the pattern index after KNOWLEDGE_BASE changes"""
+    return install_pattern_index(PatternIndex(KNOWLEDGE_BASE))
+
+
+def log_knowledge_base(message):
+    """Report a reload through the console log pipeline"""
+    log_pipeline.emit("knowledge_base", message)
+
+
+def reload_knowledge_base(log=log_knowledge_base):
+    """Reload the knowledge base JSON and swap it in; returns the new index or None
+
+    The outcome is reported through log(message). The gunicorn master passes
+    its own logger, so it never starts the log pipeline's thread before forking.
+    """
+    index = kb_loader.reload(log)
+    if index is not None:
+        install_pattern_index(index)
+        # Cached replies may come from entries that just changed
+        RESPONSE_CACHE.clear()
+        log(f"reloaded {len(index.knowledge_base)} categories from {kb_loader.loaded_from}")
+    return index
+
+
+def request_knowledge_base_reload(signum=None, frame=None):
+    """Reload in the background so no request waits for it (also the SIGHUP handler)"""
+    threading.Thread(target=reload_knowledge_base, name="kb-reload", daemon=True).start()
+
+
+kb_loader = KnowledgeBaseLoader()
+install_pattern_index(kb_loader.load())
+
+if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, request_knowledge_base_reload)
+
+
+# ==================================================================
+# METRICS - Lock-free counters, summed on read
+# ==================================================================
+
+class MetricsRegistry:
+    """Counters sharded per thread so increments never take a lock; shards are summed on read"""
+
+    def __init__(self, names=()):
+        self.names = tuple(names)
+        self.store = None  # State store used for totals across workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = dict.fromkeys(self.names, 0)  # Restored totals and finished threads
+        self._shards = []  # (thread, counts) for every thread that has counted
+
+    def incr(self, name, amount=1):
+        """Add to a counter from any thread"""
+        try:
+            shard = self._local.counts
+        except AttributeError:
+            shard = self._new_shard()
+        shard[name] = shard.get(name, 0) + amount
+
+    def add(self, totals):
+        """Fold counts (e.g. restored from the state store) into the base values"""
+        with self._lock:
+            for name, value in totals.items():
+                self._base[name] = self._base.get(name, 0) + value
+
+    def value(self, name):
+        return self.snapshot().get(name, 0)
+
+    def snapshot(self):
+        """Totals for this worker process"""
+        with self._lock:
+            self._fold_finished()
+            totals = dict(self._base)
+            shards = [shard.copy() for _, shard in self._shards]
+        for shard in shards:
+            for name, value in shard.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def aggregate(self):
+        """Totals across every worker sharing the state store (this worker only otherwise)"""
+        local = self.snapshot()
+        shared = self.store.shared_stats(local) if self.store is not None else None
+        return shared if shared is not None else local
+
+    def _new_shard(self):
+        shard = {}
+        self._local.counts = shard
+        with self._lock:
+            # A server that starts a thread per request would otherwise pile up
+            # shards until the next read
+            self._fold_finished()
+            self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_finished(self):
+        # Finished threads can't count any more, so fold them into the base (holding _lock)
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for name, value in shard.copy().items():
+                    self._base[name] = self._base.get(name, 0) + value
+        self._shards = live
+
+
+metrics = MetricsRegistry([
+    "total_messages",
+    "total_users",
+    "total_smart_calls",
+    "total_cached_calls",
+    "total_pattern_matches",
+    "total_fuzzy_matches",
+    "total_math_skipped",
+])
+
+
+# ==================================================================
+# LATENCY - Per-stage histograms for the response pipeline
+# ==================================================================
+
+# Upper bounds in seconds, Prometheus style (cumulative, plus +Inf)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LatencyHistogram:
+    """Bucketed latency distribution with count and sum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        target = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= target:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self):
+        """Count and p50/p95/p99 in milliseconds, for /health"""
+        summary = {"count": self.count}
+        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            value = self.quantile(q)
+            summary[name] = round(value * 1000, 3) if value is not None else None
+        return summary
+
+
+class _StageTimer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class LatencyRecorder:
+    """Times pipeline stages for a sampled fraction of requests"""
+
+    def __init__(self, sample_rate=LATENCY_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.histograms = {}
+        self._local = threading.local()
+        self._random = random.Random()  # Keeps sampling off the reply RNG
+        self._lock = threading.Lock()
+
+    def begin_request(self):
+        """Decide whether this thread's current request is timed"""
+        self._local.sampled = self.sample_rate >= 1 or self._random.random() < self.sample_rate
+
+    def time(self, stage):
+        """Context manager timing a stage (a no-op when the request isn't sampled)"""
+        if not getattr(self._local, "sampled", False):
+            return _NO_TIMER
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return _StageTimer(histogram)
+
+    def summary(self):
+        return {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+
+    def prometheus(self):
+        """Histogram and quantile lines in the Prometheus text format"""
+        lines = [
+            "# HELP chatbot_stage_latency_seconds Time spent in each response pipeline stage",
+            "# TYPE chatbot_stage_latency_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            with histogram._lock:
+                counts = list(histogram.counts)
+                total, seconds = histogram.count, histogram.sum
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'chatbot_stage_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'chatbot_stage_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+            lines.append(f'chatbot_stage_latency_seconds_sum{{stage="{stage}"}} {seconds}')
+            lines.append(f'chatbot_stage_latency_seconds_count{{stage="{stage}"}} {total}')
+        lines.append("# HELP chatbot_stage_latency_quantile_seconds Estimated latency quantiles per stage")
+        lines.append("# TYPE chatbot_stage_latency_quantile_seconds gauge")
+        for stage, histogram in sorted(self.histograms.items()):
+            for q in (0.5, 0.95, 0.99):
+                value = histogram.quantile(q)
+                if value is not None:
+                    lines.append(f'chatbot_stage_latency_quantile_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+        return lines
+
+
+latency = LatencyRecorder()
+
+
+# ==================================================================
+# RESPONSE CACHE - Pluggable backends with TTL expiry
+# ==================================================================
+# Every backend provides get(key), set(key, response, ttl=None), sweep(),
+# clear(), stats() and len().
+
+class ResponseCache:
+    """In-process, size-bounded LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_DURATION,
+                 sweep_interval=CACHE_SWEEP_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()  # key -> (response, expires_at), oldest first
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Return the cached response for key, or None if missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now >= entry[1]:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, response, ttl=None):
+        """Store a response, evicting least recently used entries when full"""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            self._entries[key] = (response, now + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def sweep(self):
+        """Drop every expired entry"""
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters for /health and the dashboard"""
+        return {
+            "backend": "memory",
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _maybe_sweep(self, now):
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        expired = [key for key, (_, expires_at) in self._entries.items() if now >= expires_at]
+        for key in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        self._next_sweep = now + self.sweep_interval
+
+
+def connect_sqlite(path, schema):
+    """Open a WAL-mode SQLite connection and make sure the schema exists"""
+    conn = sqlite3.connect(path, timeout=1.0, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+class SQLiteResponseCache:
+    """Cache in a local SQLite file (WAL mode) shared by every worker process"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS response_cache ("
+        "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS response_cache_expiry ON response_cache (expires_at)",
+    )
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_DURATION,
+                 sweep_interval=CACHE_SWEEP_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = time.time() + sweep_interval
+        self._writes_since_trim = 0
+        # Counters are per process; the stored entries are shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        self._connection()
+
+    def _connection(self):
+        """One connection per thread, reopened after gunicorn forks a worker"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, self.SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        """Return the cached response for key, or None if missing or expired"""
+        now = time.time()
+        try:
+            self._maybe_sweep(now)
+            row = self._connection().execute(
+                "SELECT response, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        if row is None or now >= row[1]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, response, ttl=None):
+        """Store a response; the entries closest to expiry are evicted when full"""
+        now = time.time()
+        try:
+            self._maybe_sweep(now)
+            self._connection().execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, response, now + (self.ttl if ttl is None else ttl)),
+            )
+            # Trimming counts rows, so only do it every few writes
+            self._writes_since_trim += 1
+            if self._writes_since_trim * 10 >= self.max_entries:
+                self._trim()
+        except sqlite3.Error:
+            self.errors += 1
+
+    def sweep(self):
+        """Drop every expired entry and trim to max_entries"""
+        try:
+            self._sweep(time.time())
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self):
+        """Drop every entry"""
+        try:
+            self._connection().execute("DELETE FROM response_cache")
+        except sqlite3.Error:
+            self.errors += 1
+
+    def __len__(self):
+        return self._size() or 0
+
+    def stats(self):
+        """Counters for /health and the dashboard"""
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "size": self._size(),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "errors": self.errors,
+        }
+
+    def _size(self):
+        # Entry count, or None if the file is busy or unreadable
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+
+    def _maybe_sweep(self, now):
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        self._next_sweep = now + self.sweep_interval
+        cursor = self._connection().execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        self.expirations += max(cursor.rowcount, 0)
+        self._trim()
+
+    def _trim(self):
+        self._writes_since_trim = 0
+        cursor = self._connection().execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.evictions += max(cursor.rowcount, 0)
+
+
+CACHE_BACKENDS = {
+    "memory": ResponseCache,
+    "sqlite": SQLiteResponseCache,
+}
+
+
+def create_response_cache(backend=CACHE_BACKEND):
+    """Build the cache backend named by CACHE_BACKEND"""
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown CACHE_BACKEND {backend!r}, expected one of {sorted(CACHE_BACKENDS)}")
+    return CACHE_BACKENDS[backend]()
+
+
+RESPONSE_CACHE = create_response_cache()
+
+
+# ==================================================================
+# STATE STORE - Conversations, stats and message log persistence
+# ==================================================================
+# Reads are always served from memory. A state store only loads state the
+# process doesn't have yet and saves changes in the background.
+
+class MemoryStateStore:
+    """Keeps no state outside this process (the default)"""
+
+    name = "memory"
+
+    def load_conversation(self, phone):
+        """Return (turns, version) for a user, or None"""
+        return None
+
+    def conversation_version(self, phone):
+        """Version (update time) of the stored conversation, or None"""
+        return None
+
+    def save_conversation(self, phone, turns, version):
+        """Queue a user's turns to be saved"""
+        pass
+
+    def load_message_log(self, limit):
+        """Most recent message log rows, oldest first"""
+        return []
+
+    def append_message_log(self, record):
+        """Queue a message log record to be saved"""
+        pass
+
+    def restore_stats(self, metrics):
+        """Add persisted counters into the registry and track it for saving"""
+        pass
+
+    def shared_stats(self, local):
+        """Counter totals across every worker, or None if state isn't shared"""
+        return None
+
+    def flush(self):
+        """Write queued changes now"""
+        pass
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """Persists state to a local SQLite file with batched background writes"""
+
+    name = "sqlite"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "phone TEXT PRIMARY KEY, turns TEXT NOT NULL, version REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS conversations_version ON conversations (version)",
+        "CREATE TABLE IF NOT EXISTS message_log ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, phone TEXT, type TEXT, "
+        "message TEXT, response TEXT)",
+        "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    )
+
+    def __init__(self, path=STATE_PATH, flush_interval=STATE_FLUSH_INTERVAL,
+                 log_retention=MESSAGE_LOG_SIZE, conversation_ttl=CONVERSATION_IDLE_TTL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.log_retention = log_retention  # Message log rows kept (the dashboard reads these)
+        self.conversation_ttl = conversation_ttl  # Conversations idle longer than this are deleted
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_conversations = {}  # phone -> (turns json, version), latest wins
+        self._pending_log = []
+        self._metrics = None
+        self._saved_stats = {}
+        self._writer_pid = None
+        self.errors = 0
+        self._connection()
+        atexit.register(self.flush)
+
+    def _connection(self):
+        """One connection per thread, reopened after gunicorn forks a worker"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, self.SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def load_conversation(self, phone):
+        try:
+            row = self._connection().execute(
+                "SELECT turns, version FROM conversations WHERE phone = ?", (phone,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def conversation_version(self, phone):
+        with self._lock:
+            pending = self._pending_conversations.get(phone)
+        if pending is not None:
+            return pending[1]
+        try:
+            row = self._connection().execute(
+                "SELECT version FROM conversations WHERE phone = ?", (phone,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        return row[0] if row else None
+
+    def save_conversation(self, phone, turns, version):
+        data = json.dumps([(turn.role, turn.content) for turn in turns], ensure_ascii=False)
+        with self._lock:
+            self._pending_conversations[phone] = (data, version)
+        self._ensure_writer()
+
+    def load_message_log(self, limit):
+        try:
+            rows = self._connection().execute(
+                "SELECT created, phone, type, message, response FROM message_log "
+                "ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        except sqlite3.Error:
+            self.errors += 1
+            return []
+        return rows[::-1]
+
+    def append_message_log(self, record):
+        with self._lock:
+            self._pending_log.append(
+                (record.created, record.phone, record.type, record.message, record.response))
+        self._ensure_writer()
+
+    def restore_stats(self, metrics):
+        metrics.add(self._load_stats() or {})
+        # Only increments made by this process are written back
+        self._metrics = metrics
+        self._saved_stats = metrics.snapshot()
+        metrics.store = self
+
+    def shared_stats(self, local):
+        stored = self._load_stats()
+        if stored is None:
+            return None
+        # Flushed totals from every worker plus this worker's unflushed increments
+        with self._lock:
+            saved = dict(self._saved_stats)
+        for name, value in local.items():
+            stored[name] = stored.get(name, 0) + value - saved.get(name, 0)
+        return stored
+
+    def _load_stats(self):
+        try:
+            return dict(self._connection().execute("SELECT name, value FROM stats").fetchall())
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+
+    def flush(self):
+        """Write every pending change in one transaction"""
+        with self._lock:
+            conversations_batch = [(phone, data, version) for phone, (data, version)
+                                   in self._pending_conversations.items()]
+            log_batch = self._pending_log
+            self._pending_conversations = {}
+            self._pending_log = []
+            stats_batch = []
+            if self._metrics is not None:
+                for name, value in self._metrics.snapshot().items():
+                    saved = self._saved_stats.get(name, 0)
+                    if value != saved:
+                        stats_batch.append((name, value - saved))
+                        self._saved_stats[name] = value
+        if not (conversations_batch or log_batch or stats_batch):
+            return
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT INTO conversations (phone, turns, version) VALUES (?, ?, ?) "
+                    "ON CONFLICT(phone) DO UPDATE SET turns = excluded.turns, version = excluded.version "
+                    "WHERE excluded.version >= conversations.version",
+                    conversations_batch)
+                conn.executemany(
+                    "INSERT INTO message_log (created, phone, type, message, response) "
+                    "VALUES (?, ?, ?, ?, ?)", log_batch)
+                conn.executemany(
+                    "INSERT INTO stats (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    stats_batch)
+                # Keep the file bounded like the in-memory state
+                if log_batch:
+                    conn.execute(
+                        "DELETE FROM message_log WHERE id <= (SELECT MAX(id) FROM message_log) - ?",
+                        (self.log_retention,))
+                if conversations_batch:
+                    conn.execute("DELETE FROM conversations WHERE version < ?",
+                                 (time.time() - self.conversation_ttl,))
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            self.errors += 1
+
+    def _ensure_writer(self):
+        """Start the background writer (again after a fork, where threads don't survive)"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, name="state-writer", daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+STATE_STORES = {
+    "memory": MemoryStateStore,
+    "sqlite": SQLiteStateStore,
+}
+
+
+def create_state_store(backend=STATE_BACKEND):
+    """Build the state store named by STATE_BACKEND"""
+    if backend not in STATE_STORES:
+        raise ValueError(f"Unknown STATE_BACKEND {backend!r}, expected one of {sorted(STATE_STORES)}")
+    return STATE_STORES[backend]()
+
+
+STATE_STORE = create_state_store()
+STATE_STORE.restore_stats(metrics)
+
+
+# ==================================================================
+# LOG PIPELINE - Console logging off the request thread
+# ==================================================================
+
+LOG_LEVELS = {"quiet": 0, "info": 1, "verbose": 2}
+
+
+class LogPipeline:
+    """Request threads queue compact records; a background thread formats and writes them"""
+
+    def __init__(self, level=LOG_LEVEL, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE):
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Unknown LOG_LEVEL {level!r}, expected one of {sorted(LOG_LEVELS)}")
+        self.level = LOG_LEVELS[level]
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer_pid = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0  # Records discarded because the queue was full
+        atexit.register(self.flush)
+
+    def emit(self, kind, *fields):
+        """Queue a record; never blocks, drops the record if the queue is full"""
+        if not self.level:
+            return
+        try:
+            self._queue.put_nowait((kind, time.time(), fields))
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+
+    def flush(self):
+        """Format and write everything queued so far"""
+        while self._write_batch(block=False):
+            pass
+
+    def stats(self):
+        """Counters for /health"""
+        return {
+            "level": next(name for name, value in LOG_LEVELS.items() if value == self.level),
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def _start_writer(self):
+        # Threads don't survive a fork, so each gunicorn worker starts its own
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, name="log-writer", daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            self._write_batch(block=True)
+
+    def _write_batch(self, block):
+        try:
+            batch = [self._queue.get(block=block)]
+        except queue.Empty:
+            return False
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        text = "".join(self._format(kind, created, fields) for kind, created, fields in batch)
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass
+        self.written += len(batch)
+        return True
+
+    def _format(self, kind, created, fields):
+        timestamp = datetime.fromtimestamp(created, WAT).strftime("%H:%M:%S")
+        if kind == "received":
+            from_number, message = fields
+            if self.level == 1:
+                return f"📩 [{timestamp}] {from_number}: {message}\n"
+            return (f"\n{'='*60}\n"
+                    f"📩 [{timestamp}] NEW MESSAGE\n"
+                    f"From: {from_number}\n"
+                    f"Message: {message}\n"
+                    f"{'='*60}\n")
+        if kind == "replied":
+            response, sentiment = fields
+            if self.level == 1:
+                return f"💬 [{timestamp}] {response}" + (f" ({sentiment})\n" if sentiment else "\n")
+            return ("🧠 Generating smart response...\n"
+                    f"💬 Response: {response}\n"
+                    + (f"😊 Sentiment: {sentiment}\n" if sentiment else "")
+                    + "✅ Message sent!\n"
+                    f"{'='*60}\n\n")
+        return f"[{timestamp}] {kind}: {' '.join(str(field) for field in fields)}\n"
+
+
+log_pipeline = LogPipeline()
+
+
+# ==================================================================
+# MESSAGE LOG - Fixed-size ring buffer for the dashboard
+# ==================================================================
+
+class LogRecord:
+    """One logged message; timestamp and response are formatted only when displayed"""
+
+    __slots__ = ("created", "phone", "type", "message", "reply")
+
+    def __init__(self, created, phone, msg_type, message, reply):
+        self.created = created
+        self.phone = phone
+        self.type = msg_type
+        self.message = message
+        self.reply = reply
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created, WAT).strftime("%Y-%m-%d %H:%M:%S")
+
+    @property
+    def response(self):
+        return self.reply[:100] + "..." if len(self.reply) > 100 else self.reply
+
+    def to_dict(self):
+        return {
+            "timestamp": self.timestamp,
+            "phone": self.phone,
+            "type": self.type,
+            "message": self.message,
+            "response": self.response,
+        }
+
+
+class MessageLog:
+    """Ring buffer of the most recent records, optionally spilling older ones to disk"""
+
+    def __init__(self, capacity=MESSAGE_LOG_SIZE, spill_path=MESSAGE_LOG_PATH, store=None,
+                 flush_interval=STATE_FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.store = store or MemoryStateStore()
+        self.flush_interval = flush_interval
+        self._records = [None] * capacity
+        self._next = 0  # Slot the next record is written to
+        self._count = 0
+        self._lock = threading.Lock()
+        self._pending_spill = []  # Evicted records waiting for the background writer
+        self._writer_pid = None
+        for row in self.store.load_message_log(capacity):
+            self._push(LogRecord(*row))
+        if spill_path:
+            atexit.register(self.flush)
+
+    def append(self, record):
+        """Add a record, overwriting the oldest once the buffer is full"""
+        evicted = self._push(record)
+        self.store.append_message_log(record)
+        if evicted is not None and self.spill_path:
+            with self._lock:
+                self._pending_spill.append(evicted)
+            self._ensure_writer()
+
+    def _push(self, record):
+        with self._lock:
+            evicted = self._records[self._next]
+            self._records[self._next] = record
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+        return evicted
+
+    def recent(self, limit=10):
+        """Newest records first"""
+        with self._lock:
+            count = min(limit, self._count)
+            return [self._records[(self._next - 1 - i) % self.capacity] for i in range(count)]
+
+    def __len__(self):
+        return self._count
+
+    def flush(self):
+        """Append every evicted record still pending to the spill file"""
+        with self._lock:
+            batch = self._pending_spill
+            self._pending_spill = []
+        if not batch:
+            return
+        text = "".join(json.dumps(record.to_dict(), ensure_ascii=False) + "\n" for record in batch)
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(text)
+        except OSError:
+            pass
+
+    def _ensure_writer(self):
+        """Start the background writer (again after a fork, where threads don't survive)"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, name="spill-writer", daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+message_log = MessageLog(store=STATE_STORE)
+
+
+# ==================================================================
+# CONVERSATION STORE - Bounded per-user history with idle eviction
+# ==================================================================
+
+class Turn:
+    """One message in a conversation"""
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+
+
+class Conversation:
+    """A user's recent turns; the deque drops the oldest automatically"""
+
+    __slots__ = ("turns", "last_active", "version", "next_check", "topic")
+
+    def __init__(self, now, turns=(), version=0.0):
+        self.turns = deque((Turn(role, content) for role, content in turns), maxlen=CONVERSATION_HISTORY)
+        self.last_active = now
+        self.version = version  # Wall-clock time of the last change, compared across workers
+        self.next_check = now  # When the stored version may next be compared (monotonic)
+        # Topic of the last reply ("jokes", "facts" or None), kept up to date as
+        # replies are stored so follow-ups never rescan the history
+        last = self.turns[-1] if self.turns else None
+        self.topic = reply_topic(last.content) if last is not None and last.role == "assistant" else None
+
+    def add_exchange(self, message, response):
+        """Record a user message and the reply to it"""
+        self.turns.append(Turn("user", message))
+        self.turns.append(Turn("assistant", response))
+        self.topic = reply_topic(response)
+
+    def clear(self):
+        self.turns.clear()
+        self.topic = None
+
+
+def reply_topic(response):
+    """The follow-up topic of a knowledge base reply, or None"""
+    return PATTERN_INDEX.response_topic.get(response)
+
+
+class SeenFilter:
+    """Fixed-size Bloom filter of keys seen so far; rarely, a new key looks already seen"""
+
+    def __init__(self, bits=CONVERSATION_SEEN_BITS, hashes=5):
+        self.bits = bits
+        self.hashes = hashes
+        self._filter = bytearray(bits // 8)
+
+    def add(self, key):
+        """Remember key; returns True if it had not been seen before"""
+        value = hash(key)
+        step = (value >> 32) | 1
+        new = False
+        for i in range(self.hashes):
+            bit = (value + i * step) % self.bits
+            mask = 1 << (bit & 7)
+            if not self._filter[bit >> 3] & mask:
+                self._filter[bit >> 3] |= mask
+                new = True
+        return new
+
+
+class ConversationStore:
+    """Conversations keyed by phone number, bounded by idle TTL and user count"""
+
+    def __init__(self, max_users=CONVERSATION_MAX_USERS, idle_ttl=CONVERSATION_IDLE_TTL,
+                 sweep_interval=CONVERSATION_SWEEP_INTERVAL, store=None, check_interval=STATE_FLUSH_INTERVAL):
+        self.store = store or MemoryStateStore()
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.check_interval = check_interval
+        self._conversations = OrderedDict()  # phone -> Conversation, least recently active first
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._seen = SeenFilter()  # Users evicted from memory still count as seen
+        self.evictions = 0
+
+    def open(self, phone):
+        """Return (conversation, created) and mark the user as active
+
+        created is True only for users neither this process nor the state
+        store has seen before, even if they were evicted since.
+        """
+        now = time.monotonic()
+        conversation = self._conversations.get(phone)
+        in_memory = conversation is not None
+        if conversation is None or self._stored_is_newer(phone, conversation, now):
+            # Unknown here, or another worker has replied since: load the stored copy
+            stored = self.store.load_conversation(phone)
+            if stored is not None:
+                turns, version = stored
+                conversation = Conversation(now, turns, version)
+                conversation.next_check = now + self.check_interval
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            # Every user loaded into memory goes into the filter, so one who was
+            # evicted and comes back is not counted again
+            created = not in_memory and self._seen.add(phone) and conversation is None
+            if conversation is None:
+                conversation = Conversation(now)
+            conversation.last_active = now
+            self._conversations[phone] = conversation
+            self._conversations.move_to_end(phone)
+            while len(self._conversations) > self.max_users:
+                self._conversations.popitem(last=False)
+                self.evictions += 1
+            return conversation, created
+
+    def _stored_is_newer(self, phone, conversation, now):
+        # Other workers only write every STATE_FLUSH_INTERVAL, so checking a
+        # user more often than that would never find a newer copy
+        if now < conversation.next_check:
+            return False
+        conversation.next_check = now + self.check_interval
+        version = self.store.conversation_version(phone)
+        return version is not None and version > conversation.version
+
+    def add_exchange(self, phone, conversation, message, response):
+        """Record a user message and reply, and queue the change for saving"""
+        conversation.add_exchange(message, response)
+        self._save(phone, conversation)
+
+    def _save(self, phone, conversation):
+        conversation.version = max(time.time(), conversation.version + 1e-6)
+        self.store.save_conversation(phone, conversation.turns, conversation.version)
+
+    def get(self, phone):
+        """The user's conversation, or None (does not mark the user active)"""
+        return self._conversations.get(phone)
+
+    def history(self, phone):
+        """The user's recent turns (not a copy), or an empty tuple"""
+        conversation = self._conversations.get(phone)
+        return conversation.turns if conversation is not None else ()
+
+    def message_count(self, phone):
+        return len(self.history(phone))
+
+    def reset(self, phone):
+        """Clear a user's history; returns how many messages were dropped, or None if unknown"""
+        with self._lock:
+            conversation = self._conversations.get(phone)
+            if conversation is None:
+                return None
+            count = len(conversation.turns)
+            conversation.clear()
+        self._save(phone, conversation)
+        return count
+
+    def clear(self):
+        """Forget every user"""
+        with self._lock:
+            self._conversations.clear()
+
+    def __contains__(self, phone):
+        return phone in self._conversations
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def _sweep(self, now):
+        # Oldest activity is at the front, so stop at the first user still active
+        cutoff = now - self.idle_ttl
+        while self._conversations:
+            phone, conversation = next(iter(self._conversations.items()))
+            if conversation.last_active > cutoff:
+                break
+            del self._conversations[phone]
+            self.evictions += 1
+        self._next_sweep = now + self.sweep_interval
+
+
+conversations = ConversationStore(store=STATE_STORE)
+
+
 # ==================================================================
 # SMART RESPONSE FUNCTIONS
 # ==================================================================
 
 def log_message(phone, message, response, msg_type="user"):
     """Log all messages for analytics"""
-    message_log.append({
-        "timestamp": datetime.now(WAT).strftime("%Y-%m-%d %H:%M:%S"),
-        "phone": phone[-4:] if len(phone) >= 4 else phone,
-        "type": msg_type,
-        "message": message,
-        "response": response[:100] + "..." if len(response) > 100 else response
-    })
-    stats["total_messages"] += 1
+    message_log.append(LogRecord(time.time(), phone[-4:], msg_type, message, response))
+    metrics.incr("total_messages")
 
 
-def get_sentiment(text):
-    """Enhanced sentiment analysis"""
-    positive_words = ["good", "great", "awesome", "excellent", "happy", "love", "best",
-                      "thanks", "amazing", "wonderful", "fantastic", "brilliant", "perfect",
-                      "nice", "cool", "super", "beautiful", "excited", "glad", "pleased"]
-    negative_words = ["bad", "terrible", "awful", "hate", "worst", "sad", "angry",
-                      "disappointed", "horrible", "disgusting", "annoying", "frustrated",
-                      "upset", "unhappy", "depressed", "boring", "stupid", "ugly"]
-
-    text_lower = text.lower()
-    pos_count = sum(1 for word in positive_words if word in text_lower)
-    neg_count = sum(1 for word in negative_words if word in text_lower)
-
-    if pos_count > neg_count:
+def normalize_message(message):
+    """Lowercase and trim a message once; shared by the cache key and the matchers"""
+    return message.lower().strip()
+
+
+class MessageTokens:
+    """A message tokenized once; spelling, sentiment, context and matching all read from it"""
+
+    __slots__ = ("message", "normalized", "chunks", "words", "_word_set", "_corrected")
+
+    def __init__(self, message, normalized=None):
+        self.message = message
+        self.normalized = normalize_message(message) if normalized is None else normalized
+        # Whitespace-separated chunks as typed, and the same chunks without punctuation
+        self.chunks = self.normalized.split()
+        self.words = [chunk.strip(string.punctuation) for chunk in self.chunks]
+        self._word_set = None
+        self._corrected = None
+
+    @property
+    def word_set(self):
+        if self._word_set is None:
+            self._word_set = frozenset(self.words)
+        return self._word_set
+
+    @property
+    def corrected(self):
+        """The normalized message with spelling corrections applied (computed once)"""
+        if self._corrected is None:
+            self._corrected = spell_correct(self.chunks, self.words)
+        return self._corrected
+
+
+def sentiment_score(chunks, words):
+    """Weighted lexicon score in one pass over the words; negations flip the next few
+
+    chunks are the words as typed (MessageTokens.chunks); their punctuation
+    ends a negation's clause.
+    """
+    score = 0
+    negate_until = -1
+    lexicon = SENTIMENT_LEXICON
+    for position, (chunk, word) in enumerate(zip(chunks, words)):
+        weight = lexicon.get(word)
+        if weight:
+            score += -weight if position <= negate_until else weight
+        elif word in NEGATIONS:
+            negate_until = position + NEGATION_WINDOW
+        if chunk.endswith(CLAUSE_ENDINGS):
+            negate_until = -1
+    return score
+
+
+def sentiment_label(score):
+    if score > 0:
         return "😊 Positive"
-    elif neg_count > pos_count:
+    elif score < 0:
         return "😔 Negative"
     return "😐 Neutral"
 
 
-def correct_spelling(message):
-    """Apply spelling corrections"""
+def get_sentiment(text):
+    """Enhanced sentiment analysis"""
+    chunks = text.lower().split()
+    return sentiment_label(sentiment_score(chunks, [chunk.strip(string.punctuation) for chunk in chunks]))
+
+
+def get_sentiments(texts):
+    """Batch sentiment for analytics: one label per text"""
+    return [get_sentiment(text) for text in texts]
+
+
+def spell_correct(chunks, words):
+    """Join the chunks back up, replacing misspelled words (dictionary first, then the KB vocabulary)"""
     if not FEATURES["spelling_correction"]:
-        return message
+        return " ".join(chunks)
 
-    words = message.lower().split()
+    spelling = PATTERN_INDEX.spelling
+    lookups = SPELLING_MAX_LOOKUPS
     corrected = []
-    for word in words:
-        clean_word = word.strip(string.punctuation)
-        if clean_word in SPELLING_CORRECTIONS:
-            corrected.append(SPELLING_CORRECTIONS[clean_word])
-        else:
-            corrected.append(word)
+    for chunk, word in zip(chunks, words):
+        replacement = SPELLING_CORRECTIONS.get(word)
+        if replacement is None and lookups and word not in spelling.known:
+            lookups -= 1
+            replacement = spelling.correct(word)
+        corrected.append(chunk if replacement is None else replacement)
     return " ".join(corrected)
 
 
-def calculate_expression(message):
-    """Enhanced math expression calculator"""
-    try:
-        # Clean the message
-        text = message.lower()
-        text = text.replace("what is", "").replace("calculate", "").replace("compute", "")
-        text = text.replace("what's", "").replace("whats", "")
-        text = text.replace("x", "*").replace("×", "*").replace("÷", "/")
-        text = text.replace("plus", "+").replace("minus", "-")
-        text = text.replace("times", "*").replace("divided by", "/")
-        text = text.replace("multiplied by", "*")
-
-        # Try to find and evaluate expression
-        # Pattern for basic math: number operator number
-        pattern = r'(-?\d+\.?\d*)\s*([\+\-\*/\^])\s*(-?\d+\.?\d*)'
-        match = re.search(pattern, text)
-
-        if match:
-            num1, operator, num2 = float(match.group(1)), match.group(2), float(match.group(3))
-
-            if operator == '+':
-                result = num1 + num2
-            elif operator == '-':
-                result = num1 - num2
-            elif operator == '*':
-                result = num1 * num2
-            elif operator == '/':
-                if num2 == 0:
-                    return "🔢 Can't divide by zero! That's undefined in mathematics."
-                result = num1 / num2
-            elif operator == '^':
-                result = num1 ** num2
-
-            # Format result nicely
-            if result == int(result):
-                result = int(result)
-            else:
-                result = round(result, 4)
+def correct_spelling(message):
+    """Apply spelling corrections to a message (text or MessageTokens)"""
+    tokens = message if isinstance(message, MessageTokens) else MessageTokens(message)
+    return tokens.corrected
+
 
-            return f"🔢 {int(num1) if num1 == int(num1) else num1} {operator} {int(num2) if num2 == int(num2) else num2} = {result}"
+# Numbers, word operators ("divided by" before any other word), symbols;
+# any other word or symbol breaks the expression. Digits are ASCII only:
+# "²" or "٣" is just a symbol, never a number
+MATH_TOKEN = re.compile(r"(?P<number>[0-9]+(?:\.[0-9]+)?|\.[0-9]+)|divided by|multiplied by|[a-z']+|\*\*|\S")
+
+# Every expression contains a number, so messages without a digit skip the math engine
+MATH_HINT = re.compile(r"[0-9]")
+
+MATH_OPERATORS = {
+    "+": "+", "plus": "+",
+    "-": "-", "minus": "-",
+    "*": "*", "x": "*", "×": "*", "times": "*", "multiplied by": "*",
+    "/": "/", "÷": "/", "divided by": "/",
+    "^": "^", "**": "^",
+}
 
-        # Try to evaluate simple expressions with multiple operators
-        expr_pattern = r'^[\d\s\+\-\*/\.\(\)]+$'
-        clean_text = re.sub(r'[^\d\s\+\-\*/\.\(\)]', '', text).strip()
-        if clean_text and re.match(expr_pattern, clean_text):
+# Binding strength of each operator; "neg" is unary minus, which binds
+# looser than ^ so that -2^2 = -4 and 2^-1 = 0.5
+MATH_PRECEDENCE = {"+": 1, "-": 1, "*": 2, "/": 2, "neg": 3, "^": 4}
+MATH_RIGHT_ASSOCIATIVE = {"^", "neg"}
+
+
+class MathError(ValueError):
+    """An expression that parsed but cannot be answered; the message is the reply"""
+
+
+def math_runs(message):
+    """Split a message into runs of consecutive number/operator/parenthesis tokens"""
+    runs = []
+    run = []
+    for found in MATH_TOKEN.finditer(message.lower()):
+        token = found.group()
+        if found.lastgroup == "number":
+            run.append(float(token))
+        elif token in MATH_OPERATORS:
+            run.append(MATH_OPERATORS[token])
+        elif token in "()":
+            run.append(token)
+        elif run:
+            runs.append(run)
+            run = []
+            continue
+        else:
+            continue
+        # Stop scanning as soon as an expression is too long to evaluate
+        if len(run) > MATH_MAX_TOKENS:
+            raise MathError("🔢 That expression is too long for me! Try breaking it into smaller steps.")
+    if run:
+        runs.append(run)
+    return runs
+
+
+def compile_expression(tokens):
+    """Shunting-yard: infix tokens to a postfix program, or None if they are not an expression"""
+    program = []
+    stack = []
+    depth = 0
+    expect_operand = True
+    for token in tokens:
+        if type(token) is float:
+            if not expect_operand:
+                return None
+            if abs(token) > MATH_MAX_OPERAND:
+                raise MathError("🔢 That number is too big for me! Try something smaller.")
+            program.append(token)
+            expect_operand = False
+        elif token == "(":
+            if not expect_operand:
+                return None
+            depth += 1
+            if depth > MATH_MAX_DEPTH:
+                raise MathError("🔢 That expression is nested too deeply for me!")
+            stack.append(token)
+        elif token == ")":
+            if expect_operand:
+                return None
+            while stack and stack[-1] != "(":
+                program.append(stack.pop())
+            if not stack:
+                return None
+            stack.pop()
+            depth -= 1
+        elif expect_operand:
+            # Only a sign can come before an operand
+            if token == "-":
+                stack.append("neg")
+            elif token != "+":
+                return None
+        else:
+            precedence = MATH_PRECEDENCE[token]
+            while stack and stack[-1] != "(":
+                top = MATH_PRECEDENCE[stack[-1]]
+                if top > precedence or (top == precedence and token not in MATH_RIGHT_ASSOCIATIVE):
+                    program.append(stack.pop())
+                else:
+                    break
+            stack.append(token)
+            expect_operand = True
+
+    if expect_operand:
+        return None
+    while stack:
+        token = stack.pop()
+        if token == "(":
+            return None
+        program.append(token)
+    return program
+
+
+def run_expression(program):
+    """Evaluate a postfix program within MATH_MAX_STEPS operations"""
+    values = []
+    steps = 0
+    for token in program:
+        if type(token) is float:
+            values.append(token)
+            continue
+
+        steps += 1
+        if steps > MATH_MAX_STEPS:
+            raise MathError("🔢 That expression is too long for me! Try breaking it into smaller steps.")
+        if token == "neg":
+            values.append(-values.pop())
+            continue
+
+        right = values.pop()
+        left = values.pop()
+        if token == "+":
+            result = left + right
+        elif token == "-":
+            result = left - right
+        elif token == "*":
+            result = left * right
+        elif token == "/":
+            if right == 0:
+                raise MathError("🔢 Can't divide by zero! That's undefined in mathematics.")
+            result = left / right
+        else:
+            if abs(right) > MATH_MAX_EXPONENT:
+                raise MathError("🔢 That number is too big for me! Try something smaller.")
             try:
-                # Safe evaluation of basic math
-                result = eval(clean_text, {"__builtins__": {}}, {})
-                if isinstance(result, (int, float)):
-                    if result == int(result):
-                        result = int(result)
-                    else:
-                        result = round(result, 4)
-                    return f"🔢 {clean_text} = {result}"
-            except:
-                pass
+                result = left ** right
+            except ZeroDivisionError:
+                raise MathError("🔢 Can't divide by zero! That's undefined in mathematics.")
+            except OverflowError:
+                raise MathError("🔢 That number is too big for me! Try something smaller.")
+            if isinstance(result, complex):
+                raise MathError("🔢 That has no real answer! (negative numbers have no real fractional powers)")
+        if not abs(result) <= MATH_MAX_RESULT:
+            raise MathError("🔢 That number is too big for me! Try something smaller.")
+        values.append(result)
+    return values[0]
+
+
+def format_number(value):
+    """Whole numbers without a decimal point, others to 4 places"""
+    return int(value) if value == int(value) else round(value, 4)
+
+
+def format_expression(tokens):
+    """Display form of an expression, e.g. (2 + 3) * -4"""
+    parts = []
+    expect_operand = True
+    for token in tokens:
+        if type(token) is float:
+            parts.append(str(format_number(token)))
+            expect_operand = False
+        elif token == "(":
+            parts.append("(")
+        elif token == ")":
+            parts.append(")")
+        elif expect_operand:
+            parts.append(token if token == "-" else "")
+        else:
+            parts.append(f" {token} ")
+            expect_operand = True
+    return "".join(parts)
 
-    except Exception as e:
-        pass
+
+def calculate_expression(message):
+    """Find an arithmetic expression in the message and evaluate it safely"""
+    try:
+        for tokens in math_runs(message):
+            if len(tokens) < 3:
+                continue
+            program = compile_expression(tokens)
+            # A lone number ("ww2", "-5") is not a calculation
+            if program is None or all(type(token) is float or token == "neg" for token in program):
+                continue
+            result = run_expression(program)
+            return f"🔢 {format_expression(tokens)} = {format_number(result)}"
+    except MathError as error:
+        return str(error)
     return None
 
 
-def get_cache_key(message):
-    """Generate cache key from message"""
-    return hashlib.md5(message.lower().strip().encode()).hexdigest()
+def get_cache_key(normalized):
+    """Cache key for a normalized message (the text itself; no hashing needed in-process)"""
+    return normalized
 
 
-def get_cached_response(message):
+def get_cached_response(normalized):
     """Check if we have a cached response"""
     if not FEATURES["response_caching"]:
         return None
 
-    cache_key = get_cache_key(message)
-    if cache_key in RESPONSE_CACHE:
-        cached = RESPONSE_CACHE[cache_key]
-        if datetime.now(WAT) < cached["expires"]:
-            stats["total_cached_calls"] += 1
-            return cached["response"]
-        else:
-            del RESPONSE_CACHE[cache_key]
-    return None
+    cached = RESPONSE_CACHE.get(get_cache_key(normalized))
+    if cached is not None:
+        metrics.incr("total_cached_calls")
+    return cached
 
 
-def cache_response(message, response):
-    """Cache a response"""
+def cache_response(normalized, response, ttl=None):
+    """Cache a response (for CACHE_DURATION seconds unless ttl is given)"""
     if not FEATURES["response_caching"]:
         return
 
-    cache_key = get_cache_key(message)
-    RESPONSE_CACHE[cache_key] = {
-        "response": response,
-        "expires": datetime.now(WAT) + timedelta(seconds=CACHE_DURATION)
-    }
+    RESPONSE_CACHE.set(get_cache_key(normalized), response, ttl)
+
+
+def is_context_dependent(message):
+    """Follow-ups like "another one" are answered from conversation history"""
+    tokens = message if isinstance(message, MessageTokens) else MessageTokens(message)
+    return not CONTEXT_WORDS.isdisjoint(tokens.word_set)
+
+
+def response_cache_ttl(data, template):
+    """How long a rendered knowledge base reply stays correct in the cache (0 = never cache)"""
+    if not data.get("cacheable", True):
+        return 0
+    if type(template) is not str:
+        return min(CACHE_DURATION, template.ttl())
+    return data.get("cache_ttl", CACHE_DURATION)
+
+
+def knowledge_response(category, index=None):
+    """Pick and render one of the category's replies; returns (response, cache_ttl)"""
+    index = index or PATTERN_INDEX
+    template = random.choice(index.responses[category])
+    response = render_response(template)
+    return response, response_cache_ttl(index.knowledge_base[category], template)
 
 
 def fuzzy_match(message, patterns, threshold=0.7):
-    """Find best fuzzy match for message against patterns"""
+    """Find best fuzzy match for message against patterns (a list or a FuzzyIndex)"""
     if not FEATURES["fuzzy_matching"]:
         return None, 0
 
+    if isinstance(patterns, FuzzyIndex):
+        return patterns.best_match(message, threshold)
+
     message_lower = message.lower()
     best_match = None
     best_score = 0
@@ -979,115 +2452,71 @@ def fuzzy_match(message, patterns, threshold=0.7):
     return best_match, best_score
 
 
-def extract_context(message, conversation_history):
-    """Extract context from conversation for better responses"""
-    context = {
-        "is_question": "?" in message or any(q in message.lower() for q in ["what", "who", "where", "when", "why", "how"]),
-        "is_greeting": any(g in message.lower() for g in ["hello", "hi", "hey"]),
-        "is_farewell": any(f in message.lower() for f in ["bye", "goodbye", "later"]),
-        "recent_topic": None
+def extract_context(message, conversation=None):
+    """Intent flags for the message plus the topic of the user's last reply"""
+    tokens = message if isinstance(message, MessageTokens) else MessageTokens(message)
+    words = tokens.word_set
+    return {
+        "is_question": "?" in tokens.normalized or not QUESTION_WORDS.isdisjoint(words),
+        "is_greeting": not GREETING_WORDS.isdisjoint(words),
+        "is_farewell": not FAREWELL_WORDS.isdisjoint(words),
+        "recent_topic": conversation.topic if conversation is not None else None,
     }
 
-    # Check recent conversation for context
-    if conversation_history and len(conversation_history) >= 2:
-        last_exchange = conversation_history[-2:]
-        for msg in last_exchange:
-            if msg.get("role") == "assistant":
-                content = msg.get("content", "").lower()
-                if "joke" in content:
-                    context["recent_topic"] = "jokes"
-                elif "fact" in content:
-                    context["recent_topic"] = "facts"
 
-    return context
+def get_smart_response(message, phone, tokens=None):
+    """Intelligent response using pattern matching and fuzzy logic
 
+    Returns (response, cache_ttl) where cache_ttl is how many seconds the
+    response may be cached for (0 = do not cache). Pass tokens if the
+    caller already built MessageTokens(message).
+    """
 
-def get_smart_response(message, phone):
-    """Intelligent response using pattern matching and fuzzy logic"""
+    # One index for the whole request, even if a reload swaps it meanwhile
+    index = PATTERN_INDEX
 
     # Apply spelling correction
-    corrected_message = correct_spelling(message)
-    message_lower = corrected_message.lower().strip()
-    original_lower = message.lower().strip()
+    if tokens is None:
+        tokens = MessageTokens(message)
+    original_lower = tokens.normalized
+    with latency.time("spelling_correction"):
+        message_lower = tokens.corrected
 
     # Check for math expressions first
-    math_result = calculate_expression(message)
-    if math_result:
-        stats["total_pattern_matches"] += 1
-        return math_result
+    if MATH_HINT.search(original_lower):
+        with latency.time("calculate_expression"):
+            math_result = calculate_expression(message)
+        if math_result:
+            metrics.incr("total_pattern_matches")
+            return math_result, CACHE_DURATION
+    else:
+        metrics.incr("total_math_skipped")
 
     # Get conversation context
-    conversation_history = conversations.get(phone, [])
-    context = extract_context(message, conversation_history)
+    with latency.time("extract_context"):
+        context = extract_context(tokens, conversations.get(phone))
 
     # Handle "another" or "more" requests based on context
-    if any(word in message_lower for word in ["another", "more", "again", "one more"]):
-        if context["recent_topic"] == "jokes":
-            data = KNOWLEDGE_BASE.get("joke", {})
-            if data.get("responses"):
-                stats["total_pattern_matches"] += 1
-                return random.choice(data["responses"])
-        elif context["recent_topic"] == "facts":
-            data = KNOWLEDGE_BASE.get("fact", {})
-            if data.get("responses"):
-                stats["total_pattern_matches"] += 1
-                return random.choice(data["responses"])
-
-    # Build a list of all (pattern, category) pairs and sort by length (longest first)
-    # This ensures specific patterns like "capital of canada" match before generic "capital of"
-    all_pattern_pairs = []
-    for category, data in KNOWLEDGE_BASE.items():
-        for pattern in data["patterns"]:
-            all_pattern_pairs.append((pattern, category))
-    all_pattern_pairs.sort(key=lambda x: len(x[0]), reverse=True)
-
-    # Exact pattern matching in knowledge base
-    for pattern, category in all_pattern_pairs:
-        # For short patterns (5 chars or less), require whole word match
-        # This prevents "cat" matching inside "education", "no" inside "information", etc.
-        if len(pattern) <= 5:
-            if re.search(r'\b' + re.escape(pattern) + r'\b', message_lower) or re.search(r'\b' + re.escape(pattern) + r'\b', original_lower):
-                data = KNOWLEDGE_BASE[category]
-                response = random.choice(data["responses"])
-                if response == "__TIME__":
-                    response = f"⏰ The current time is: {datetime.now(WAT).strftime('%I:%M %p')}"
-                elif response == "__DATE__":
-                    response = f"📅 Today is: {datetime.now(WAT).strftime('%B %d, %Y (%A)')}"
-                stats["total_pattern_matches"] += 1
-                return response
-        else:
-            if pattern in message_lower or pattern in original_lower:
-                data = KNOWLEDGE_BASE[category]
-                response = random.choice(data["responses"])
-                if response == "__TIME__":
-                    response = f"⏰ The current time is: {datetime.now(WAT).strftime('%I:%M %p')}"
-                elif response == "__DATE__":
-                    response = f"📅 Today is: {datetime.now(WAT).strftime('%B %d, %Y (%A)')}"
-                stats["total_pattern_matches"] += 1
-                return response
+    if context["recent_topic"] and is_context_dependent(tokens):
+        category = index.topic_category.get(context["recent_topic"])
+        if category and index.responses[category]:
+            metrics.incr("total_pattern_matches")
+            response, _ = knowledge_response(category, index)
+            return response, 0
+
+    # Exact pattern matching in knowledge base (longest pattern wins)
+    with latency.time("exact_match"):
+        category = index.match(message_lower, original_lower)
+    if category:
+        metrics.incr("total_pattern_matches")
+        return knowledge_response(category, index)
 
     # Fuzzy matching for close matches
-    all_patterns = []
-    pattern_to_category = {}
-    for category, data in KNOWLEDGE_BASE.items():
-        for pattern in data["patterns"]:
-            all_patterns.append(pattern)
-            pattern_to_category[pattern] = category
-
-    best_match, score = fuzzy_match(message_lower, all_patterns, threshold=0.65)
+    with latency.time("fuzzy_match"):
+        best_match, score = fuzzy_match(message_lower, index.fuzzy, threshold=0.65)
     if best_match and score >= 0.65:
-        category = pattern_to_category[best_match]
-        data = KNOWLEDGE_BASE[category]
-        response = random.choice(data["responses"])
-
-        # Handle dynamic responses
-        if response == "__TIME__":
-            response = f"⏰ The current time is: {datetime.now(WAT).strftime('%I:%M %p')}"
-        elif response == "__DATE__":
-            response = f"📅 Today is: {datetime.now(WAT).strftime('%B %d, %Y (%A)')}"
-
-        stats["total_fuzzy_matches"] += 1
-        return response
+        metrics.incr("total_fuzzy_matches")
+        return knowledge_response(index.pattern_to_category[best_match], index)
 
     # Context-aware default responses
     if context["is_question"]:
@@ -1103,40 +2532,44 @@ def get_smart_response(message, phone):
             f"💬 I'd love to help! Here are things I'm good at:\n• Jokes & facts\n• Math calculations\n• Time & date\n• General knowledge\n\nJust ask!",
         ]
 
-    return random.choice(default_responses)
+    return random.choice(default_responses), CACHE_DURATION
 
 
 def get_response(message, phone):
     """Main response function with caching and conversation memory"""
 
     # Initialize conversation for new users
-    if phone not in conversations:
-        conversations[phone] = []
-        stats["total_users"] += 1
+    conversation, created = conversations.open(phone)
+    if created:
+        metrics.incr("total_users")
+
+    # Tokenize once for sentiment, the cache key, spelling and matching
+    tokens = MessageTokens(message)
+    normalized = tokens.normalized
 
     # Get sentiment
-    sentiment = get_sentiment(message) if FEATURES["sentiment"] else ""
+    with latency.time("sentiment"):
+        sentiment = sentiment_label(sentiment_score(tokens.chunks, tokens.words)) if FEATURES["sentiment"] else ""
 
-    # Check cache first
-    cached_response = get_cached_response(message)
+    # Check cache first (follow-ups depend on this user's history, so skip it)
+    context_dependent = is_context_dependent(tokens)
+    with latency.time("cache_lookup"):
+        cached_response = None if context_dependent else get_cached_response(normalized)
     if cached_response:
-        conversations[phone].append({"role": "user", "content": message})
-        conversations[phone].append({"role": "assistant", "content": cached_response})
-        conversations[phone] = conversations[phone][-10:]  # Keep last 10 messages
+        conversations.add_exchange(phone, conversation, message, cached_response)
         log_message(phone, message, cached_response, "cached")
         return cached_response, sentiment
 
     # Generate smart response
-    response = get_smart_response(message, phone)
-    stats["total_smart_calls"] += 1
+    response, cache_ttl = get_smart_response(message, phone, tokens)
+    metrics.incr("total_smart_calls")
 
     # Cache the response
-    cache_response(message, response)
+    if cache_ttl and not context_dependent:
+        cache_response(normalized, response, cache_ttl)
 
     # Update conversation history
-    conversations[phone].append({"role": "user", "content": message})
-    conversations[phone].append({"role": "assistant", "content": response})
-    conversations[phone] = conversations[phone][-10:]  # Keep last 10 messages
+    conversations.add_exchange(phone, conversation, message, response)
 
     log_message(phone, message, response, "smart")
     return response, sentiment
@@ -1146,6 +2579,19 @@ def get_response(message, phone):
 # FLASK ROUTES
 # ==================================================================
 
+@app.before_request
+def sample_request_latency():
+    """Decide per request whether pipeline stages are timed"""
+    latency.begin_request()
+
+
+@app.before_request
+def check_knowledge_base():
+    """Pick up edits to the knowledge base JSON without a restart"""
+    if kb_loader.changed():
+        request_knowledge_base_reload()
+
+
 @app.route("/whatsapp", methods=["POST"])
 def whatsapp_webhook():
     """Handle incoming WhatsApp messages"""
@@ -1153,12 +2599,7 @@ def whatsapp_webhook():
     incoming_msg = request.form.get('Body', '').strip()
     from_number = request.form.get('From', '')
 
-    timestamp = datetime.now(WAT).strftime("%H:%M:%S")
-    print(f"\n{'='*60}")
-    print(f"📩 [{timestamp}] NEW MESSAGE")
-    print(f"From: {from_number}")
-    print(f"Message: {incoming_msg}")
-    print(f"{'='*60}")
+    log_pipeline.emit("received", from_number, incoming_msg)
 
     resp = MessagingResponse()
     msg = resp.message()
@@ -1180,9 +2621,8 @@ def whatsapp_webhook():
         return str(resp)
 
     if incoming_msg.lower() in ['/reset', 'reset']:
-        if from_number in conversations:
-            msg_count = len(conversations[from_number])
-            conversations[from_number] = []
+        msg_count = conversations.reset(from_number)
+        if msg_count is not None:
             msg.body(f"✅ Cleared {msg_count} messages!\n\nFresh start! What's on your mind?")
         else:
             msg.body("✅ Already fresh! What can I help you with?")
@@ -1209,9 +2649,10 @@ def whatsapp_webhook():
         return str(resp)
 
     if incoming_msg.lower() in ['/stats', 'stats']:
-        uptime = datetime.now(WAT) - stats["start_time"]
+        stats = metrics.aggregate()
+        uptime = datetime.now(WAT) - START_TIME
         uptime_mins = int(uptime.total_seconds() / 60)
-        user_msg_count = len(conversations.get(from_number, []))
+        user_msg_count = conversations.message_count(from_number)
 
         msg.body(
             f"📊 *Bot Statistics*\n\n"
@@ -1229,27 +2670,25 @@ def whatsapp_webhook():
         return str(resp)
 
     # Generate Response
-    print("🧠 Generating smart response...")
-    response, sentiment = get_response(incoming_msg, from_number)
+    with latency.time("get_response"):
+        response, sentiment = get_response(incoming_msg, from_number)
 
     # Send response
-    msg.body(response)
-
-    print(f"💬 Response: {response}")
-    if sentiment:
-        print(f"😊 Sentiment: {sentiment}")
-    print(f"✅ Message sent!")
-    print(f"{'='*60}\n")
+    with latency.time("twiml_render"):
+        msg.body(response)
+        twiml = str(resp)
+    log_pipeline.emit("replied", response, sentiment)
 
-    return str(resp)
+    return twiml
 
 
 @app.route("/")
 def dashboard():
     """Web dashboard"""
-    uptime = datetime.now(WAT) - stats["start_time"]
+    stats = metrics.aggregate()
+    uptime = datetime.now(WAT) - START_TIME
     uptime_str = str(uptime).split('.')[0]
-    recent_msgs = message_log[-10:][::-1]
+    recent_msgs = message_log.recent(10)
 
     html = """
     <!DOCTYPE html>
@@ -1453,15 +2892,32 @@ def dashboard():
 @app.route("/health")
 def health():
     """Health check endpoint"""
+    stats = metrics.aggregate()
+    stats["start_time"] = START_TIME
     return {
         "status": "healthy",
         "mode": AI_PROVIDER,
-        "uptime_seconds": int((datetime.now(WAT) - stats["start_time"]).total_seconds()),
+        "uptime_seconds": int((datetime.now(WAT) - START_TIME).total_seconds()),
         "features": FEATURES,
-        "stats": stats
+        "stats": stats,
+        "cache": RESPONSE_CACHE.stats(),
+        "logging": log_pipeline.stats(),
+        "latency": latency.summary(),
+        "knowledge_base": kb_loader.stats()
     }
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition: counters and per-stage latency histograms"""
+    lines = []
+    for name, value in sorted(metrics.aggregate().items()):
+        lines.append(f"# TYPE chatbot_{name} counter")
+        lines.append(f"chatbot_{name} {value}")
+    lines.extend(latency.prometheus())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/test-response", methods=["GET"])
 def test_response():
     """Test endpoint to verify response generation"""
@@ -1469,6 +2925,7 @@ def test_response():
     test_phone = "test_user"
 
     response, sentiment = get_response(test_message, test_phone)
+    stats = metrics.aggregate()
 
     return {
         "status": "success",
@@ -1510,6 +2967,5 @@ if __name__ == "__main__":
     print("   This bot runs entirely on local pattern matching and NLP.")
     print("\n" + "="*70 + "\n")
 
-    import os
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
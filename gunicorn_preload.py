@@ -0,0 +1,45 @@
+"""Gunicorn preload mode: build the knowledge base once in the master, fork the workers from it
+
+    gunicorn -c gunicorn_preload.py chat:app
+
+The master imports chat.py (banner, knowledge base, pattern indexes, Flask app)
+before forking, so workers start with everything already built and share those
+pages copy-on-write instead of each importing and compiling its own copy.
+Connections and background threads are per process in chat.py and are reopened
+in each worker on first use.
+"""
+
+import gc
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8000")
+preload_app = True
+
+
+def freeze_heap():
+    # Move every object the master has built into the permanent generation.
+    # Collections in the workers then never traverse them, so they don't write
+    # to (and un-share) the pages the knowledge base and indexes live on.
+    gc.collect()
+    gc.freeze()
+
+
+def when_ready(server):
+    freeze_heap()
+
+
+def on_reload(server):
+    # On SIGHUP the master replaces its workers but, with the app preloaded,
+    # never re-imports chat.py. Recompile the knowledge base here so the new
+    # workers inherit the current one. Report through gunicorn's logger: the
+    # console log pipeline would start a writer thread in the master, and a
+    # fork while that thread holds a lock leaves the lock held in the worker.
+    # Anything raised here would escape Arbiter.reload() and stop the master,
+    # so a failure is logged and the workers start on what the master has.
+    try:
+        import chat
+
+        chat.reload_knowledge_base(log=server.log.info)
+        freeze_heap()
+    except Exception:
+        server.log.exception("knowledge base reload failed, keeping the previous version")